@@ -0,0 +1,149 @@
+#
+# Relay2Tetris batch of instruction-level HACK CPUs. Holds any number of independent HACK
+# machines (lanes) running the same program as NumPy arrays, one element per lane, and
+# executes an instruction on all of them at once with masked vector operations, so that
+# the cases of a test script, or thousands of generated inputs, run side by side in one
+# process. Each lane behaves exactly like the Hack CPU (see Modules/Hack.py).
+#
+# NumPy is only needed for this engine; the rest of the simulator runs without it.
+#
+# (C)2019 Robert Woodhead - trebor@animeigo.com
+# License: Creative Commons Attribution-NonCommercial-ShareAlike 4.0 International (CC BY-NC-SA 4.0)
+#
+
+from Modules.Comp import Color
+
+import sys
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# Columns of the decoded ROM: a row per instruction, with the value of an A instruction,
+# and the control bits of a C instruction (the ALU bits, where y comes from, what is
+# stored, and the jump condition bits).
+
+IS_C, VALUE, ZX, NX, ZY, NY, F, NO, USE_M, STORE_A, STORE_D, STORE_M, JLT, JEQ, JGT = range(15)
+
+
+def decode(instruction):
+
+    if not instruction & 0x8000:
+        return [0, instruction] + [0] * 13
+
+    return [1, 0] + [(instruction >> bit) & 1 for bit in (11, 10, 9, 8, 7, 6, 12, 5, 4, 3, 2, 1, 0)]
+
+
+class Batch:
+    """ Batch of instruction-level HACK CPUs
+
+        lanes is the number of machines. rom is the list of machine code instructions, asm the
+        matching assembly code (optional), and decoded the decoded ROM (see decode()), as a
+        NumPy array. pc, a, d and prev_pc are the registers of every lane, ram the RAM of
+        every lane (a row each), and instr_count the number of instructions each one executed.
+    """
+
+    RAM_SIZE = 32768
+
+    def __init__(self, code, lanes, asm=None):
+
+        if np is None:
+            sys.exit(f'{Color.RED}# The batch engine requires NumPy.{Color.END}')
+
+        self.lanes = lanes
+        self.rom = code
+        self.asm = asm
+        self.decoded = np.array([decode(instruction) for instruction in code], dtype=np.uint16).reshape(-1, 15)
+
+        self.ram = np.zeros((lanes, Batch.RAM_SIZE), dtype=np.uint16)
+        self.pc = np.zeros(lanes, dtype=np.int64)
+        self.a = np.zeros(lanes, dtype=np.uint16)
+        self.d = np.zeros(lanes, dtype=np.uint16)
+        self.prev_pc = np.full(lanes, -1, dtype=np.int64)
+        self.instr_count = np.zeros(lanes, dtype=np.int64)
+
+    # Test script interface: read and write the RAM of a lane (poke can also write to several
+    # lanes at once, given an array or slice of lanes and a value or array of values).
+
+    def peek(self, lane, addr):
+
+        return int(self.ram[lane, addr])
+
+    def poke(self, lane, addr, value):
+
+        self.ram[lane, addr] = np.asarray(value) & 0xFFFF
+
+    # True for each lane whose last instruction jumped to itself (the HACK end-of-program idiom).
+
+    def halted(self):
+
+        return self.pc == self.prev_pc
+
+    # Execute up to count instructions on every lane (count can also be a list or array with a
+    # count for each lane), each one stopping early if its program halts (but always executing
+    # at least one). Returns the number of instructions each lane executed.
+
+    def run(self, count):
+
+        decoded = self.decoded
+        ram = self.ram
+        counts = np.broadcast_to(np.asarray(count, dtype=np.int64), (self.lanes,))
+        executed = np.zeros(self.lanes, dtype=np.int64)
+        lanes = np.flatnonzero(counts > 0)      # The lanes still running
+
+        while len(lanes):
+
+            pc = self.pc[lanes]
+            a = self.a[lanes]
+            d = self.d[lanes]
+
+            if (pc >= len(decoded)).any():
+                lane = lanes[pc >= len(decoded)][0]
+                sys.exit(f'{Color.RED}Error: ROM address [{self.pc[lane]}] is out of bounds (lane {lane})!{Color.END}')
+
+            instructions = decoded[pc]
+            fields = instructions.T.astype(bool)
+            is_c = fields[IS_C]
+            memory = is_c & (fields[USE_M] | fields[STORE_M])
+
+            if (a[memory] >= Batch.RAM_SIZE).any():
+                lane = lanes[memory & (a >= Batch.RAM_SIZE)][0]
+                sys.exit(f'{Color.RED}Error: RAM address [{self.a[lane]}] is out of bounds (lane {lane})!{Color.END}')
+
+            # The ALU (the A instructions ignore the result).
+
+            addr = np.where(memory, a, 0)
+            x = np.where(fields[ZX], 0, d).astype(np.uint16)
+            x = np.where(fields[NX], ~x, x)
+            y = np.where(fields[USE_M], ram[lanes, addr], a)
+            y = np.where(fields[ZY], 0, y).astype(np.uint16)
+            y = np.where(fields[NY], ~y, y)
+            out = np.where(fields[F], x + y, x & y)
+            out = np.where(fields[NO], ~out, out)
+
+            # Store the result (M at the address in A at the start of the instruction), and
+            # branch to the new value of A.
+
+            store_m = is_c & fields[STORE_M]
+            ram[lanes[store_m], addr[store_m]] = out[store_m]
+
+            a = np.where(is_c, np.where(fields[STORE_A], out, a), instructions[:, VALUE])
+            self.a[lanes] = a
+            self.d[lanes] = np.where(is_c & fields[STORE_D], out, d)
+
+            zero = out == 0
+            negative = out >= 0x8000
+            jump = is_c & ((fields[JLT] & negative) | (fields[JEQ] & zero) | (fields[JGT] & ~zero & ~negative))
+            next_pc = np.where(jump, a, pc + 1)
+
+            self.prev_pc[lanes] = pc
+            self.pc[lanes] = next_pc
+
+            executed[lanes] += 1
+            lanes = lanes[(next_pc != pc) & (executed[lanes] < counts[lanes])]
+
+        self.instr_count += executed
+
+        return executed
@@ -12,9 +12,16 @@
 # Base Class for all components
 # --------------------------------------------------------------
 
+from Modules.Memory import PagedMemory
+
+from collections import OrderedDict
+from operator import itemgetter, is_
+
 import sys
 import re
 
+PURE_CACHE_SIZE = 1024      # Input patterns remembered by each class of pure component
+
 
 class Color:
     """ Color codes: see https://stackoverflow.com/questions/8924173/how-do-i-print-bold-text-in-python """
@@ -48,6 +55,42 @@ def powered(power, signals):
     return False
 
 
+class PureCache:
+    """ Outputs of a class of pure components for the input patterns seen recently
+
+        entries[key] is the tuple of output values for a key (the input and power values,
+        and their types, since False and 0 are different signals). hits and misses count
+        lookups, skips the updates that were skipped because the inputs had not changed.
+    """
+
+    def __init__(self, size=PURE_CACHE_SIZE):
+
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.skips = 0
+
+    def get(self, key):
+
+        outputs = self.entries.get(key)
+
+        if outputs is None:
+            self.misses += 1
+        else:
+            self.entries.move_to_end(key)
+            self.hits += 1
+
+        return outputs
+
+    def put(self, key, outputs):
+
+        self.entries[key] = outputs
+
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
 class Component:
     """ Base hardware component class
 
@@ -57,9 +100,34 @@ class Component:
         state is a dictionary of internal state that is maintained by the component, or config parameters.
         emulated is True if we are doing a software emulation.
         sequence is the definition sequence, used to sort components when displaying detailed machine state.
+
+        stateful is True for components that hold state from one tick to the next (registers, RAM,
+        sequencer...), as opposed to combinational logic whose outputs only depend on the inputs.
+
+        pure is True for components whose outputs are a function of their inputs and power alone,
+        always in the same order (the names don't matter). Their outputs can be cached, in the
+        cache of their class (see refresh_pure()).
+
+        gated is True for components that turn their outputs off when they have no power, whatever
+        their inputs are. dark is True when such a component was last updated without power, so
+        it doesn't need to be updated again until it gets power (see refresh()).
     """
 
     __sequence__ = 0
+    stateful = False
+    pure = False
+    gated = True
+    dark = False
+    last = None         # Inputs and power of the last update of a pure component
+
+    # Every class of pure components gets its own cache.
+
+    def __init_subclass__(cls, **kwargs):
+
+        super().__init_subclass__(**kwargs)
+
+        if cls.pure:
+            cls.cache = PureCache()
 
     # Massage the inputs into regular form, handle defaults.
 
@@ -121,8 +189,8 @@ class Component:
     def update(self, signals={}):
 
         # Update the state of the controls and inputs from the global machine state
-        # subclasses will use this for their initial update, then compute output.
-        # This is done both to validate inputs and for potential tracing later on.
+        # then compute output. This is done both to validate inputs and for potential
+        # tracing later on.
 
         for c in self.inputs:
             if c in signals:
@@ -136,6 +204,143 @@ class Component:
             else:
                 sys.exit(f'{Color.RED}Error: Component [{self.name}] requires unknown power signal [{c}]{Color.END}')
 
+        self.evaluate()
+
+    # Compute outputs and internal state from the current inputs and power; subclasses
+    # override this.
+
+    def evaluate(self):
+
+        pass
+
+    # True if any of the power sources is active (the inputs must be current).
+
+    def is_powered(self):
+
+        return any(self.power.values())
+
+    # Bind the component to the integer signal slots of a compiled netlist. Each
+    # list is of (signal name, slot) pairs.
+
+    def bind(self, input_slots, power_slots, output_slots):
+
+        self.input_slots = input_slots
+        self.power_slots = power_slots
+        self.output_slots = output_slots
+
+        # What a pure component's outputs depend on (plus slot 0, TRUE, so that it is always a tuple).
+
+        self.key_slots = itemgetter(*[slot for _, slot in input_slots + power_slots], 0)
+        self.output_names = [output for output, _ in output_slots]
+
+    # Fetch inputs and power directly from a compiled netlist's signal vector. Signal
+    # names were checked when the netlist was compiled, so no validation is needed.
+
+    def fetch(self, values):
+
+        inputs = self.inputs
+        for name, slot in self.input_slots:
+            inputs[name] = values[slot]
+
+        power = self.power
+        for name, slot in self.power_slots:
+            power[name] = values[slot]
+
+    # Fetch inputs and power from a compiled netlist's signal vector, and compute the outputs
+    # (what the settle functions do for every board they update). A dark component is skipped
+    # as long as it has no power: its outputs are already off, and its inputs don't matter.
+    # Whatever changes a board from outside must clear dark (see Netlist.touch()).
+
+    def refresh(self, values):
+
+        if self.dark:
+            for _, slot in self.power_slots:
+                if values[slot]:
+                    break
+            else:
+                return
+
+        inputs = self.inputs
+        for name, slot in self.input_slots:
+            inputs[name] = values[slot]
+
+        on = False
+        power = self.power
+        for name, slot in self.power_slots:
+            if values[slot]:
+                on = True
+            power[name] = values[slot]
+
+        self.evaluate()
+        self.dark = self.gated and not on
+
+    # refresh() for pure components, when caching is on (see set_pure_caching()): it does nothing
+    # if the inputs and power are the very same values as the last time, and takes the outputs
+    # from the cache of the class if they were seen recently. Whatever changes the outputs of a
+    # board from outside (restoring a tick, the tick cache) must set last to None.
+
+    def refresh_pure(self, values):
+
+        inputs = self.key_slots(values)
+        last = self.last
+
+        if last is not None and all(map(is_, inputs, last)):
+            self.cache.skips += 1
+            return
+
+        key = (inputs, tuple(map(type, inputs)))
+        outputs = self.cache.get(key)
+
+        if outputs is None:
+            self.fetch(values)
+            self.evaluate()
+            self.cache.put(key, tuple([self.outputs[output] for output in self.output_names]))
+        else:
+            self.outputs.update(zip(self.output_names, outputs))
+
+        self.last = inputs
+
+
+# The classes of pure components.
+
+def pure_classes():
+
+    classes = [Component]
+    found = []
+
+    while classes:
+        cls = classes.pop()
+        classes.extend(cls.__subclasses__())
+        if cls.pure:
+            found.append(cls)
+
+    return sorted(found, key=lambda cls: cls.__name__)
+
+
+# Turn the caching of pure components on or off, with empty caches of size entries. It is
+# off by default, since the components are so simple that looking their inputs up costs about
+# as much as computing the outputs.
+
+def set_pure_caching(on, size=PURE_CACHE_SIZE):
+
+    for cls in pure_classes():
+        cls.cache = PureCache(size)
+        if on:
+            cls.refresh = Component.refresh_pure
+        elif "refresh" in cls.__dict__:
+            del cls.refresh
+
+
+# The statistics of the pure component caches, by class.
+
+def pure_stats():
+
+    return {cls.__name__: {"hits": cls.cache.hits,
+                           "misses": cls.cache.misses,
+                           "skips": cls.cache.skips,
+                           "entries": len(cls.cache.entries)}
+            for cls in pure_classes()}
+
 
 # --------------------------------------------------------------
 # Reset button
@@ -147,6 +352,8 @@ class Reset(Component):
         No inputs (but has set/clear functions).
     """
 
+    stateful = True
+
     def __init__(self,
                  name="RESET",
                  inputs=[],
@@ -173,11 +380,9 @@ class Reset(Component):
 
     # Update state of the component.
 
-    def update(self, signals={}):
-
-        super().update(signals)
+    def evaluate(self):
 
-        if not powered(self.power, signals):
+        if not self.is_powered():
             for output in self.outputs.keys():
                 self.outputs[output] = False
             self.state["RESET"] = False
@@ -216,6 +421,8 @@ class Clock(Component):
         Can have multiple outputs, but why would you?
     """
 
+    stateful = True
+
     def __init__(self,
                  name="CLOCK",
                  inputs=[],
@@ -239,11 +446,9 @@ class Clock(Component):
 
     # Update state of the component.
 
-    def update(self, signals={}):
+    def evaluate(self):
 
-        super().update(signals)
-
-        if not powered(self.power, signals):
+        if not self.is_powered():
             for output in self.outputs.keys():
                 self.outputs[output] = False
             self.state["TICKTOCK"] = False
@@ -285,6 +490,8 @@ class Sequencer(Component):
         state["TICKS"] is how many cycles there are in a machine instruction.
     """
 
+    stateful = True
+
     def __init__(self,
                  name="SEQUENCER",
                  inputs=["CLOCK", "RESET"],
@@ -320,13 +527,11 @@ class Sequencer(Component):
 
     # Update state of the component.
 
-    def update(self, signals={}):
-
-        super().update(signals)
+    def evaluate(self):
 
         # Handle power-off situation.
 
-        if not powered(self.power, signals):
+        if not self.is_powered():
             for output in self.outputs.keys():
                 self.outputs[output] = False
             self.state["CYCLE"] = 0
@@ -376,6 +581,10 @@ class Matrix(Component):
     """ System control generator
         state["ARRAY"] is dictionary of output:[inputs]. If any of the signals in an inputs
         list is True, the associated output is true.
+
+        The array is compiled into a bitmask of inputs for each output, and the outputs
+        for each pattern of inputs (there are only a few, one or two per sequencer step)
+        are cached the first time they are computed.
     """
 
     def __init__(self,
@@ -399,15 +608,25 @@ class Matrix(Component):
             emulated=emulated,
             sequence=sequence)
 
-    # Update state of the component.
+        # Compile the array: bit n of an output's mask is set if the nth input drives it.
 
-    def update(self, signals={}):
+        bits = {input: 1 << n for n, input in enumerate(self.inputs.keys())}
+
+        for output, inputs in self.state.get("ARRAY", {}).items():
+            for input in inputs:
+                if input not in bits:
+                    sys.exit(f'{Color.RED}Error: Component [{self.name}] array uses {input}, which is not an input.{Color.END}')
+
+        self.masks = [(output, sum(bits[input] for input in set(inputs))) for output, inputs in self.state.get("ARRAY", {}).items()]
+        self.patterns = {}
+
+    # Update state of the component.
 
-        super().update(signals)
+    def evaluate(self):
 
         # Handle power-off situation.
 
-        if not powered(self.power, signals):
+        if not self.is_powered():
             for output in self.outputs.keys():
                 self.outputs[output] = False
             return
@@ -415,8 +634,50 @@ class Matrix(Component):
         # For each item in the state array, the output is the or of all
         # the inputs. In hardware this is a sparse diode array.
 
-        for output, inputs in self.state["ARRAY"].items():
-            self.outputs[output] = any([self.inputs[input] for input in inputs])
+        key = tuple(self.inputs.values())
+        outputs = self.patterns.get(key)
+
+        if outputs is None:
+            pattern = sum(1 << n for n, value in enumerate(key) if value)
+            outputs = self.patterns[key] = {output: bool(pattern & mask) for output, mask in self.masks}
+
+        self.outputs.update(outputs)
+
+
+# --------------------------------------------------------------
+# Scan HACK assembly code (one instruction per line, with labels
+# merged into the line that follows them) for symbols. Returns a
+# {symbol: value} dictionary in order of first appearance; the
+# value is the ROM address of (labels), and None for @symbols that
+# are not labels (predefined symbols and variables).
+# --------------------------------------------------------------
+
+def scan_symbols(asm):
+
+    found = {}
+
+    # Parse the lines for @symbols and (labels). An @symbol could
+    # be a reference to a predefined location, a label, or a new
+    # symbol we need to allocate.
+
+    for addr, line in enumerate(asm):
+        match = re.search("@([A-Za-z_.$:][0-9A-Za-z_.$:]*)", line)
+        if match and match.group(1) not in found:   # New @symbol, we don't know it's value yet.
+            found[match.group(1)] = None
+
+        match = re.search("[(]([A-Za-z_.$:][0-9A-Za-z_.$:]+)[)]", line)
+        if match:
+            symbol = match.group(1)
+            if symbol in found:
+                if found[symbol] is None:           # Now we know symbol we previously saw was a
+                    found[symbol] = addr            # reference to a label, so we can set its value.
+                else:
+                    sys.exit(f'{Color.RED}Redefined symbol {symbol} in program @ {addr} : {line}.{Color.END}')
+            else:
+                found[symbol] = addr                # New label.
+
+    return found
+
 
 # --------------------------------------------------------------
 # System ROM (contains programs). Also generates fake signal
@@ -482,27 +743,7 @@ class ROM(Component):
         # Find the @symbols in the assembly code and add them to the symbols list.
         # This will make the machine display more readable.
 
-        found = {}
-
-        # Parse the lines for @symbols and (labels). An @symbol could
-        # be a reference to a predefined location, a label, or a new
-        # symbol we need to allocate.
-
-        for addr, line in enumerate(self.state["ASM"]):
-            match = re.search("@([A-Za-z_.$:][0-9A-Za-z_.$:]*)", line)
-            if match and match.group(1) not in found:   # New @symbol, we don't know it's value yet.
-                found[match.group(1)] = None
-
-            match = re.search("[(]([A-Za-z_.$:][0-9A-Za-z_.$:]+)[)]", line)
-            if match:
-                symbol = match.group(1)
-                if symbol in found:
-                    if found[symbol] is None:           # Now we know symbol we previously saw was a
-                        found[symbol] = addr            # reference to a label, so we can set its value.
-                    else:
-                        sys.exit(f'{Color.RED}Redefined symbol {symbol} in program @ {addr} : {line}.{Color.END}')
-                else:
-                    found[symbol] = addr                # New label.
+        found = scan_symbols(self.state["ASM"])
 
         # Any symbol that does not yet have a value and is not already in
         # the symbols dictionary is a new variable we need to add, starting
@@ -523,13 +764,11 @@ class ROM(Component):
 
     # Update state of the component.
 
-    def update(self, signals={}):
-
-        super().update(signals)
+    def evaluate(self):
 
         # Handle power-off situation.
 
-        if not powered(self.power, signals):
+        if not self.is_powered():
             self.outputs[self.rom] = 0x0000
             self.outputs[self.asm] = "@0"
             return
@@ -555,6 +794,8 @@ class ROM(Component):
 class Register(Component):
     """ Register """
 
+    stateful = True
+
     def __init__(self,
                  name="Register",
                  inputs=["DATA", "CLR", "STO", "GATE"],
@@ -587,13 +828,11 @@ class Register(Component):
 
     # Update state of the component.
 
-    def update(self, signals={}):
-
-        super().update(signals)
+    def evaluate(self):
 
         # Handle power-off situation.
 
-        if not powered(self.power, signals):
+        if not self.is_powered():
             for output in self.outputs.keys():
                 self.outputs[output] = False
                 self.state["DATA"] = 0x0000
@@ -619,6 +858,8 @@ class Register(Component):
 class ConditionCodes(Component):
     """ Register """
 
+    stateful = True
+
     def __init__(self,
                  name="ALUCC",
                  inputs=["CCZR", "CCNG", "CLR", "STO", "GATE"],
@@ -646,13 +887,11 @@ class ConditionCodes(Component):
 
     # Update state of the component.
 
-    def update(self, signals={}):
-
-        super().update(signals)
+    def evaluate(self):
 
         # Handle power-off situation.
 
-        if not powered(self.power, signals):
+        if not self.is_powered():
             for output in self.outputs.keys():
                 self.outputs[output] = False
                 self.state[output] = False
@@ -684,6 +923,8 @@ class ConditionCodes(Component):
 class Multiplexer(Component):
     """ Multiplexer """
 
+    pure = True
+
     def __init__(self,
                  name="Multiplexer",
                  inputs=["CTRL", "A", "B"],
@@ -715,13 +956,11 @@ class Multiplexer(Component):
 
     # Update state of the component.
 
-    def update(self, signals={}):
-
-        super().update(signals)
+    def evaluate(self):
 
         # Handle power-off situation.
 
-        if not powered(self.power, signals):
+        if not self.is_powered():
             for output in self.outputs.keys():
                 self.outputs[output] = False
             return
@@ -761,13 +1000,11 @@ class AND(Component):
 
 # Update state of the component
 
-    def update(self, signals={}):
-
-        super().update(signals)
+    def evaluate(self):
 
         # Handle power-off situation
 
-        if not powered(self.power, signals):
+        if not self.is_powered():
             for output in self.outputs.keys():
                 self.outputs[output] = False
             return
@@ -803,13 +1040,11 @@ class OR(Component):
 
 # Update state of the component.
 
-    def update(self, signals={}):
-
-        super().update(signals)
+    def evaluate(self):
 
         # Handle power-off situation.
 
-        if not powered(self.power, signals):
+        if not self.is_powered():
             for output in self.outputs.keys():
                 self.outputs[output] = False
             return
@@ -824,6 +1059,8 @@ class OR(Component):
 class ALU(Component):
     """ The Arithmetic-Logic Unit """
 
+    pure = True
+
     def __init__(self,
                  name="ALU",
                  inputs=["XREG", "YREG", "ZX", "NX", "ZY", "NY", "F", "NO"],
@@ -853,15 +1090,12 @@ class ALU(Component):
 
     # Update state of the component (nothing for now).
 
-    def update(self, signals={}):
-
-        super().update(signals)
+    def evaluate(self):
 
-        if not powered(self.power, signals):
-            self.outputs["ALU"] = 0x0000
-            self.outputs["CCLT"] = False
-            self.outputs["CCGT"] = False
-            self.outputs["CCEQ"] = False
+        if not self.is_powered():
+            self.outputs[self.alu] = 0x0000
+            self.outputs[self.zr] = False
+            self.outputs[self.ng] = False
             return
 
         # Numeric inputs.
@@ -905,6 +1139,8 @@ class ALU(Component):
 class Incrementor(Component):
     """ Adds 1 to input """
 
+    pure = True
+
     def __init__(self,
                  name="INC",
                  inputs=["INPUT"],
@@ -931,11 +1167,9 @@ class Incrementor(Component):
 
     # Update state of the component.
 
-    def update(self, signals={}):
-
-        super().update(signals)
+    def evaluate(self):
 
-        if not powered(self.power, signals):
+        if not self.is_powered():
             self.outputs[self.output] = False
             return
 
@@ -949,6 +1183,8 @@ class Incrementor(Component):
 class Branch(Component):
     """ Adds 1 to input """
 
+    pure = True
+
     def __init__(self,
                  name="BRANCH",
                  inputs=["ZR", "NG", "JLT", "JEQ", "JGT"],
@@ -972,11 +1208,9 @@ class Branch(Component):
 
     # Update state of the component.
 
-    def update(self, signals={}):
-
-        super().update(signals)
+    def evaluate(self):
 
-        if not powered(self.power, signals):
+        if not self.is_powered():
             self.outputs["BRANCH"] = False
             return
 
@@ -992,7 +1226,15 @@ class Branch(Component):
 # --------------------------------------------------------------
 
 class Decoder(Component):
-    """ Instruction Decoder """
+    """ Instruction Decoder
+
+        Decoded instructions are kept in TABLE, indexed by the instruction and
+        shared by all decoders, so each instruction is only decoded once.
+    """
+
+    pure = True
+
+    TABLE = [None] * 65536
 
     def __init__(self,
                  name="DECODE",
@@ -1019,37 +1261,48 @@ class Decoder(Component):
 
     # Update state of the component.
 
-    def update(self, signals={}):
+    def evaluate(self):
 
-        super().update(signals)
-
-        if not powered(self.power, signals):
+        if not self.is_powered():
             for output in self.outputs.keys():
                 self.outputs[output] = False
             return
 
-        bits = [b == '1' for b in format(self.inputs["INSTR"], "016b")]
+        instruction = self.inputs["INSTR"]
+        decoded = Decoder.TABLE[instruction]
+
+        if decoded is None:
+            decoded = Decoder.TABLE[instruction] = Decoder.decode(instruction)
+
+        self.outputs.update(decoded)
+
+    # Decode an instruction into a {output: value} dictionary.
+
+    @staticmethod
+    def decode(instruction):
+
+        bits = [b == '1' for b in format(instruction, "016b")]
 
         cinstr = bits[0]
         ainstr = not cinstr
-        self.outputs["CINST"] = cinstr
 
-        # Only assert control bits if C instruction, except for STOD which
+        # Only assert control bits if C instruction, except for STOA which
         # is also asserted during A instructions.
 
-        self.outputs["A"] = bits[3] and cinstr      # A or M choice.
-        self.outputs["ZX"] = bits[4] and cinstr     # 6 ALU control bits.
-        self.outputs["NX"] = bits[5] and cinstr
-        self.outputs["ZY"] = bits[6] and cinstr
-        self.outputs["NY"] = bits[7] and cinstr
-        self.outputs["F"] = bits[8] and cinstr
-        self.outputs["NO"] = bits[9] and cinstr
-        self.outputs["STOA"] = bits[10] or ainstr   # 3 register store bits.
-        self.outputs["STOD"] = bits[11] and cinstr
-        self.outputs["STOM"] = bits[12] and cinstr
-        self.outputs["JLT"] = bits[13] and cinstr   # 3 jump control bits.
-        self.outputs["JEQ"] = bits[14] and cinstr
-        self.outputs["JGT"] = bits[15] and cinstr
+        return {"CINST": cinstr,
+                "A": bits[3] and cinstr,        # A or M choice.
+                "ZX": bits[4] and cinstr,       # 6 ALU control bits.
+                "NX": bits[5] and cinstr,
+                "ZY": bits[6] and cinstr,
+                "NY": bits[7] and cinstr,
+                "F": bits[8] and cinstr,
+                "NO": bits[9] and cinstr,
+                "STOA": bits[10] or ainstr,     # 3 register store bits.
+                "STOD": bits[11] and cinstr,
+                "STOM": bits[12] and cinstr,
+                "JLT": bits[13] and cinstr,     # 3 jump control bits.
+                "JEQ": bits[14] and cinstr,
+                "JGT": bits[15] and cinstr}
 
 
 # --------------------------------------------------------------
@@ -1057,18 +1310,25 @@ class Decoder(Component):
 # --------------------------------------------------------------
 
 class RAM(Component):
-    """ RAM """
+    """ RAM
+
+        state["DATA"] is the memory and state["WHEN"] the write count when each cell was last
+        written, both PagedMemory (see Modules/Memory.py), so power-off clears are O(1) and
+        machines that are never written to much are cheap.
+    """
+
+    stateful = True
 
     SIZE = 32768
 
+    reads = None        # Cells used by the current tick, with their values before it (see Modules/Memo.py)
+
     def __init__(self,
                  name="RAM",
                  inputs=["ADDR", "DATA", "CLRMEM", "STOMEM", "STOM"],
                  outputs=["RAM"],
                  power=[],
-                 state={"DATA": [0x0000 for _ in range(SIZE)],
-                        "WHEN": [0x0000 for _ in range(SIZE)],
-                        },
+                 state={},
                  emulated=True,
                  sequence=None):
 
@@ -1084,7 +1344,19 @@ class RAM(Component):
             emulated=emulated,
             sequence=sequence)
 
+        # Every RAM gets its own memory (optionally loaded with the DATA passed in state),
+        # plus the write count for each cell, for display sorting.
+
+        data = PagedMemory(RAM.SIZE)
+        for addr, value in enumerate(self.state.get("DATA", [])):
+            if value:
+                data[addr] = value
+
+        self.state["DATA"] = data
+        self.state["WHEN"] = PagedMemory(RAM.SIZE, 'L')
+
         self.count = 0              # RAM write count for display sorting
+        self.written = set()        # Addresses written since last cleared (for co-simulation)
 
         self.ADDR = inputs[0]       # Address bus
         self.DATA = inputs[1]       # Data bus
@@ -1094,14 +1366,12 @@ class RAM(Component):
 
     # Update state of the component.
 
-    def update(self, signals={}):
-
-        super().update(signals)
+    def evaluate(self):
 
-        if not powered(self.power, signals):
+        if not self.is_powered():
             for output in self.outputs.keys():
                 self.outputs[output] = False
-            self.state["DATA"] = [0x0000 for _ in self.state["DATA"]]
+            self.state["DATA"].clear()
             return
 
         # We only have so much RAM.
@@ -1111,6 +1381,9 @@ class RAM(Component):
         if addr < 0 or addr >= len(self.state["DATA"]):
             sys.exit(f'{Color.RED}Error: RAM address [{addr}] is out of bounds!{Color.END}')
 
+        if self.reads is not None and addr not in self.reads:
+            self.reads[addr] = self.state["DATA"][addr]
+
         # No write operations can occur unless STOM is high.
 
         if self.inputs[self.STOM]:
@@ -1130,6 +1403,7 @@ class RAM(Component):
 
             self.count += 1
             self.state["WHEN"][addr] = self.count
+            self.written.add(addr)
         else:
             # Since we are not writing, return the value of the current cell
             self.outputs["RAM"] = self.state["DATA"][addr]
@@ -1142,6 +1416,9 @@ class RAM(Component):
 class Mocked(Component):
     """ Signal mockups """
 
+    stateful = True
+    gated = False           # Outputs its state whether powered or not
+
     def __init__(self,
                  name="MOCKED",
                  inputs=[],
@@ -1165,9 +1442,7 @@ class Mocked(Component):
 
     # Update state of the component.
 
-    def update(self, signals={}):
-
-        super().update(signals)
+    def evaluate(self):
 
         # Just copy state into outputs.
 
@@ -0,0 +1,213 @@
+#
+# Relay2Tetris instruction-level HACK CPU. Runs .hack programs one instruction at a time
+# instead of simulating the boards tick by tick, for when only the results matter and the
+# timing and design of the hardware do not.
+#
+# The CPU follows the behavior of the current hardware design (see Order.asm): M is read
+# and written at the address in A at the start of the instruction, but a branch goes to
+# the new value of A if the instruction also stores into A.
+#
+# (C)2019 Robert Woodhead - trebor@animeigo.com
+# License: Creative Commons Attribution-NonCommercial-ShareAlike 4.0 International (CC BY-NC-SA 4.0)
+#
+
+from Modules.Comp import Color
+
+from array import array
+
+import sys
+
+
+# -----------------------------------------------------
+# Precomputed decode tables.
+# -----------------------------------------------------
+
+# Python expression for the ALU output given the ZX, NX, ZY, NY, F and NO control bits
+# (the comp field of a C instruction) and expressions for x (D register) and y (A register
+# or M).
+
+def alu_expression(bits, x="x", y="y"):
+
+    zx, nx, zy, ny, f, no = [(bits >> (5 - bit)) & 1 for bit in range(6)]
+
+    x = "0" if zx else x
+    x = f"(~{x} & 0xFFFF)" if nx else x
+    y = "0" if zy else y
+    y = f"(~{y} & 0xFFFF)" if ny else y
+    out = f"({x} + {y})" if f else f"({x} & {y})"
+
+    return f"(~{out} & 0xFFFF)" if no else f"({out} & 0xFFFF)"
+
+
+# ALU functions for each of the 64 combinations of the control bits, generated once so
+# that each one is a single specialized expression.
+
+ALU = [eval(f"lambda x, y: {alu_expression(bits)}") for bits in range(64)]
+
+# Branch decisions for each of the 8 combinations of the JLT, JEQ and JGT bits, indexed
+# by whether the ALU output is zero, negative or positive.
+
+ZERO = 0
+NEGATIVE = 1
+POSITIVE = 2
+
+JUMP = [(bool(jump & 2), bool(jump & 4), bool(jump & 1)) for jump in range(8)]
+
+
+# Decode a machine code instruction into a tuple. A instructions are (False, value),
+# C instructions are (True, alu function, use M, store A, store D, store M, jump).
+
+def decode(instruction):
+
+    if not instruction & 0x8000:
+        return (False, instruction)
+
+    return (True,
+            ALU[(instruction >> 6) & 0x3F],
+            bool(instruction & 0x1000),
+            bool(instruction & 0x0020),
+            bool(instruction & 0x0010),
+            bool(instruction & 0x0008),
+            instruction & 0x0007)
+
+
+class Hack:
+    """ Instruction-level HACK CPU
+
+        rom is the list of machine code instructions, asm the matching assembly code (optional).
+        ram is the 32K words of RAM, as an array of unsigned 16 bit values.
+        pc, a and d are the registers; prev_pc is the PC at the start of the last instruction.
+        instr_count is the number of instructions executed.
+        written is the set of RAM addresses written by the program since it was last cleared.
+    """
+
+    RAM_SIZE = 32768
+
+    def __init__(self, code, asm=None):
+
+        self.load(code, asm)
+        self.ram = array('H', bytes(2 * Hack.RAM_SIZE))
+        self.pc = 0
+        self.a = 0
+        self.d = 0
+        self.prev_pc = -1
+        self.instr_count = 0
+        self.written = set()
+
+    # Load a program into ROM.
+
+    def load(self, code, asm=None):
+
+        self.rom = code
+        self.asm = asm
+        self.decoded = [decode(instruction) for instruction in code]
+
+    # The decoded instructions can't be pickled (for checkpoints), so they are decoded
+    # again from the ROM.
+
+    def __getstate__(self):
+
+        state = dict(self.__dict__)
+        del state["decoded"]
+
+        return state
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+        self.decoded = [decode(instruction) for instruction in self.rom]
+
+    # Test script interface: read and write RAM.
+
+    def peek(self, addr):
+
+        return self.ram[addr]
+
+    def poke(self, addr, value):
+
+        self.ram[addr] = value & 0xFFFF
+
+    # True if the last instruction jumped to itself (the HACK end-of-program idiom).
+
+    def halted(self):
+
+        return self.pc == self.prev_pc
+
+    # Execute one instruction.
+
+    def step(self, trace=0):
+
+        if trace:
+            self.print_state()
+
+        self.run(1)
+
+    # Execute up to count instructions, stopping early if the program halts (but always
+    # executing at least one). Returns the number of instructions executed. Everything is
+    # kept in local variables because this is the inner loop.
+
+    def run(self, count):
+
+        decoded = self.decoded
+        ram = self.ram
+        pc = self.pc
+        a = self.a
+        d = self.d
+        prev_pc = self.prev_pc
+        written = self.written
+        executed = 0
+
+        try:
+            while executed < count:
+
+                prev_pc = pc
+                instruction = decoded[pc]
+                executed += 1
+
+                if not instruction[0]:
+                    a = instruction[1]
+                    pc += 1
+                    continue
+
+                _, alu, use_m, store_a, store_d, store_m, jump = instruction
+
+                out = alu(d, ram[a] if use_m else a)
+
+                if store_m:
+                    ram[a] = out
+                    written.add(a)
+                if store_a:
+                    a = out
+                if store_d:
+                    d = out
+
+                if jump and JUMP[jump][ZERO if out == 0 else NEGATIVE if out & 0x8000 else POSITIVE]:
+                    pc = a
+                    if pc == prev_pc:
+                        break
+                else:
+                    pc += 1
+
+        except IndexError:
+            if pc >= len(decoded):
+                sys.exit(f'{Color.RED}Error: ROM address [{pc}] is out of bounds!{Color.END}')
+            sys.exit(f'{Color.RED}Error: RAM address [{a}] is out of bounds!{Color.END}')
+
+        finally:
+            self.pc = pc
+            self.a = a
+            self.d = d
+            self.prev_pc = prev_pc
+            self.instr_count += executed
+
+        return executed
+
+    # Print a one-line summary of the machine state.
+
+    def print_state(self):
+
+        asm = self.asm[self.pc] if self.asm and self.pc < len(self.asm) else ""
+        m = self.ram[self.a] if self.a < Hack.RAM_SIZE else 0
+
+        print(f'{Color.GREEN}Instruction {self.instr_count + 1}:{Color.END} '
+              f'PC = {self.pc:5d}  A = {self.a:5d}  D = {self.d:5d}  M = {m:5d}  {asm}')
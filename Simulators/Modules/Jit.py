@@ -0,0 +1,214 @@
+#
+# Relay2Tetris basic block translator for the instruction-level HACK CPU. Splits the ROM
+# into basic blocks (straight-line code that ends at a jump or a label) and compiles each
+# one into a Python function with the A, D and M operations inlined, so that long-running
+# programs spend their time running code instead of decoding instructions.
+#
+# Blocks are compiled the first time they are entered and cached by their entry address;
+# loading a new program into ROM throws the cache away.
+#
+# (C)2019 Robert Woodhead - trebor@animeigo.com
+# License: Creative Commons Attribution-NonCommercial-ShareAlike 4.0 International (CC BY-NC-SA 4.0)
+#
+
+from Modules.Comp import Color, scan_symbols
+from Modules.Hack import Hack, alu_expression
+
+import sys
+
+
+# Python expression for the branch condition for each of the 8 combinations of the JLT,
+# JEQ and JGT bits, given the ALU output (out).
+
+CONDITION = [None,
+             "0 < out < 0x8000",                # JGT
+             "out == 0",                        # JEQ
+             "out < 0x8000",                    # JGE
+             "out >= 0x8000",                   # JLT
+             "out != 0",                        # JNE
+             "out == 0 or out >= 0x8000",       # JLE
+             "True"]                            # JMP
+
+
+class Jit(Hack):
+    """ Instruction-level HACK CPU running compiled basic blocks
+
+        blocks is the cache of compiled blocks, {entry address: (function, length)}.
+        leaders is the set of ROM addresses that start a block (labels and jump targets).
+    """
+
+    # Load a program into ROM, and find the block boundaries.
+
+    def load(self, code, asm=None):
+
+        super().load(code, asm)
+
+        self.blocks = {}
+        self.leaders = {0}
+
+        if asm:
+            self.leaders.update(addr for addr in scan_symbols(asm).values() if addr is not None)
+
+        # A jump goes to the address in A, which is almost always loaded by the instruction
+        # just before it. Whatever follows a jump is also the start of a block.
+
+        for addr, instruction in enumerate(code):
+            if instruction & 0x8000 and instruction & 0x0007:
+                if addr > 0 and not code[addr - 1] & 0x8000:
+                    self.leaders.add(code[addr - 1])
+                self.leaders.add(addr + 1)
+
+    # Compiled blocks can't be pickled (or need to be copied); they are compiled again
+    # as needed.
+
+    def __getstate__(self):
+
+        state = super().__getstate__()
+        state["blocks"] = {}
+
+        return state
+
+    # Compile the block starting at entry into a function of (a, d, ram, written, budget,
+    # prev) that returns (next pc, a, d, instructions executed, pc of the last instruction),
+    # prev being the pc of the instruction before the block. The function never executes more
+    # than budget instructions. If an instruction would use M with A out of the range of RAM,
+    # the function returns just before it (having executed nothing if it is the first), so
+    # that the interpreter reports the error there.
+
+    def compile(self, entry):
+
+        rom = self.rom
+
+        if entry < 0 or entry >= len(rom):
+            sys.exit(f'{Color.RED}Error: ROM address [{entry}] is out of bounds!{Color.END}')
+
+        lines = []
+        pc = entry
+        target = None
+        loop = False
+        known = False       # A holds a constant (always a valid RAM address)
+
+        while True:
+
+            instruction = rom[pc]
+            count = pc - entry + 1
+
+            if not instruction & 0x8000:
+                lines.append(f"a = {instruction}")
+            else:
+                out = alu_expression((instruction >> 6) & 0x3F, x="d", y="ram[a]" if instruction & 0x1000 else "a")
+                store_a = instruction & 0x0020
+                store_d = instruction & 0x0010
+                store_m = instruction & 0x0008
+                jump = instruction & 0x0007
+
+                # Leave the block before an instruction that would use M out of range (even if
+                # it stores nothing).
+
+                if (instruction & 0x1000 or store_m) and not known:
+                    lines.append(f"if a >= {Hack.RAM_SIZE}:")
+                    lines.append(f"    return ({pc}, a, d, n + {count - 1}, {pc - 1 if count > 1 else 'prev'})")
+
+                # Only name the ALU output if it is used more than once. An instruction that
+                # stores nothing and doesn't jump does nothing.
+
+                if store_d and store_a + store_d + store_m + jump == store_d:
+                    lines.append(f"d = {out}")
+                elif store_a and store_a + store_d + store_m + jump == store_a:
+                    lines.append(f"a = {out}")
+                elif store_a or store_d or store_m or jump:
+                    lines.append(f"out = {out}")
+                    if store_m:
+                        lines.append("ram[a] = out")
+                        lines.append("written.add(a)")
+                    if store_a:
+                        lines.append("a = out")
+                    if store_d:
+                        lines.append("d = out")
+
+                if jump:
+                    loop = entry == target and not store_a
+                    if jump == 7 and not loop:
+                        lines.append(f"return (a, a, d, n + {count}, {pc})")
+                    else:
+                        lines.append(f"if {CONDITION[jump]}:")
+                        if loop:
+                            lines.append(f"    if n + {2 * count} <= budget:")
+                            lines.append(f"        n += {count}")
+                            lines.append(f"        prev = {pc}")
+                            lines.append(f"        continue")
+                        lines.append(f"    return (a, a, d, n + {count}, {pc})")
+                        lines.append(f"return ({pc + 1}, a, d, n + {count}, {pc})")
+                    break
+
+            # Remember constants loaded into A, which are usually jump targets.
+
+            target = instruction if not instruction & 0x8000 else None
+            known = not instruction & 0x8000 or (known and not instruction & 0x0020)
+            pc += 1
+
+            if pc >= len(rom) or pc in self.leaders:
+                lines.append(f"return ({pc}, a, d, n + {count}, {pc - 1})")
+                break
+
+        # A block that jumps back to its own start runs as a loop inside the function, for
+        # as long as the instruction budget allows.
+
+        if loop:
+            lines = ["while True:"] + [f"    {line}" for line in lines]
+
+        source = "def block(a, d, ram, written, budget, prev):\n    n = 0\n" + "".join(f"    {line}\n" for line in lines)
+        namespace = {}
+        exec(source, namespace)
+
+        self.blocks[entry] = (namespace["block"], count)
+
+        return self.blocks[entry]
+
+    # Execute up to count instructions, stopping early if the program halts (but always
+    # executing at least one). Returns the number of instructions executed. Whole blocks
+    # are run while they fit in count; the rest (and going out of ROM, or an instruction using
+    # M out of range, which the interpreter reports) is interpreted.
+
+    def run(self, count):
+
+        blocks = self.blocks
+        ram = self.ram
+        written = self.written
+        pc = self.pc
+        a = self.a
+        d = self.d
+        prev_pc = self.prev_pc
+        executed = 0
+        halted = False
+
+        while executed < count:
+
+            block = blocks.get(pc)
+            if block is None:
+                if pc >= len(self.rom):
+                    break       # (the interpreter reports it)
+                block = self.compile(pc)
+
+            function, length = block
+            if length > count - executed:
+                break
+
+            pc, a, d, length, prev_pc = function(a, d, ram, written, count - executed, prev_pc)
+            executed += length
+
+            if length == 0 or pc == prev_pc:
+                halted = pc == prev_pc
+                break
+
+        self.pc = pc
+        self.a = a
+        self.d = d
+        self.prev_pc = prev_pc
+        self.instr_count += executed
+
+        if executed < count and not halted:
+            executed += Hack.run(self, count - executed)
+
+        return executed
+
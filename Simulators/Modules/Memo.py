@@ -0,0 +1,141 @@
+#
+# Relay2Tetris tick cache. Remembers what a clock tick did to the board-level machine (the
+# settled signal vector, the state of the stateful boards and the RAM cells written), keyed
+# by everything the tick depends on: the signal vector before the tick and the state of the
+# stateful boards (for the clock, only whether it is high or low, not its running time). The RAM cells read during the tick are
+# checked separately, since they can't be known before the tick: an entry only applies if
+# they still hold the same values. When the machine gets back to a state it has already been
+# in, the tick is applied from the cache instead of settling the hardware again.
+#
+# The cache holds a fixed number of ticks and throws away the least recently used ones. A key
+# keeps at most VARIANTS ticks (one per set of RAM values read), so that a loop reading a cell
+# that changes on every pass doesn't fill the cache with ticks for a single key.
+#
+# (C)2019 Robert Woodhead - trebor@animeigo.com
+# License: Creative Commons Attribution-NonCommercial-ShareAlike 4.0 International (CC BY-NC-SA 4.0)
+#
+
+from collections import OrderedDict
+
+from Modules.Comp import RAM
+
+
+class TickCache:
+    """ Cache of settled clock ticks
+
+        entries[key] is the list of (reads, values, states, writes) for a key, most recently
+        used last: the RAM cells read by the tick with their values, and the signal vector,
+        states of the stateful boards and RAM cells written (with their values) after it.
+        hits and misses count lookups; size is the most ticks kept (over all keys), and count
+        the number kept.
+    """
+
+    VARIANTS = 8
+
+    def __init__(self, netlist, clock, size=4096):
+
+        self.size = size
+        self.entries = OrderedDict()
+        self.count = 0
+        self.hits = 0
+        self.misses = 0
+
+        self.clock = clock
+        self.stateful = [board for board in netlist.boards if board.stateful and board is not clock and not isinstance(board, RAM)]
+        self.ram = [board for board in netlist.boards if isinstance(board, RAM)][0]
+
+    # Everything a tick depends on, except the RAM contents.
+
+    def key(self, netlist):
+
+        return (tuple(netlist.values),
+                tuple(tuple(board.state.values()) for board in self.stateful),
+                self.clock.state["TICKTOCK"])
+
+    # Apply the tick for a key, if it is in the cache and the RAM cells it read haven't
+    # changed. Returns True if it did.
+
+    def apply(self, key, netlist):
+
+        variants = self.entries.get(key)
+
+        if variants is not None:
+
+            data = self.ram.state["DATA"]
+
+            for index, (reads, values, states, writes) in enumerate(variants):
+
+                if all(data[addr] == value for addr, value in reads):
+
+                    self.entries.move_to_end(key)
+                    variants.append(variants.pop(index))
+                    self.hits += 1
+
+                    netlist.values = list(values)
+                    netlist.dirty = set()
+
+                    for board, state in zip(self.stateful, states):
+                        board.state.update(state)
+
+                    self.clock.state["TICKTOCK"] = not self.clock.state["TICKTOCK"]
+                    self.clock.state["TIME"] += 1
+
+                    ram = self.ram
+                    for addr, value in writes:
+                        data[addr] = value
+                        ram.count += 1
+                        ram.state["WHEN"][addr] = ram.count
+                        ram.written.add(addr)
+
+                    # Keep the outputs of the boards in step with the signal vector.
+
+                    for board in netlist.boards:
+                        outputs = board.outputs
+                        for output, slot in board.output_slots:
+                            outputs[output] = values[slot]
+                        if board.pure:
+                            board.last = None
+
+                    return True
+
+        self.misses += 1
+
+        return False
+
+    # Start watching the RAM before running a tick that wasn't in the cache.
+
+    def start(self):
+
+        data = self.ram.state["DATA"]
+
+        self.ram.reads = {}
+        self.generation = data.generation
+        self.time = self.clock.state["TIME"]
+
+    # Remember what the tick did. Ticks that power the RAM off (and clear it) or stop the clock
+    # (and reset its time) are not kept.
+
+    def store(self, key, netlist):
+
+        ram = self.ram
+        data = ram.state["DATA"]
+        reads = ram.reads
+        ram.reads = None
+
+        if data.generation != self.generation or self.clock.state["TIME"] != self.time + 1:
+            return
+
+        writes = tuple((addr, data[addr]) for addr, value in reads.items() if data[addr] != value or addr in ram.written)
+        states = tuple(tuple(board.state.items()) for board in self.stateful)
+
+        variants = self.entries.setdefault(key, [])
+        variants.append((tuple(reads.items()), tuple(netlist.values), states, writes))
+        self.entries.move_to_end(key)
+        self.count += 1
+
+        if len(variants) > min(TickCache.VARIANTS, self.size):
+            del variants[0]
+            self.count -= 1
+
+        while self.count > self.size:
+            self.count -= len(self.entries.popitem(last=False)[1])
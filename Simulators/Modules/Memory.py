@@ -0,0 +1,150 @@
+#
+# Relay2Tetris paged memory. Behaves like a fixed-size list of integers, but stores them in
+# fixed-size pages of array('H') (or another array type code). Pages that have never been
+# written share a single zero page, a page is only copied the first time it is written to
+# (so memories forked from one another share everything they have not changed), and
+# clearing the whole memory is O(1): it starts a new generation, and pages from older
+# generations read as zero.
+#
+# (C)2019 Robert Woodhead - trebor@animeigo.com
+# License: Creative Commons Attribution-NonCommercial-ShareAlike 4.0 International (CC BY-NC-SA 4.0)
+#
+
+from array import array
+
+
+class PagedMemory:
+    """ Paged memory
+
+        size is the number of words, typecode the array type code of a word.
+        pages[n] is the array holding page n, generations[n] the generation it was written in,
+        and owned[n] is True if the page belongs to this memory alone (so it can be written).
+        generation is the current generation; older pages read as zero.
+    """
+
+    PAGE_BITS = 8
+    PAGE_SIZE = 1 << PAGE_BITS
+    PAGE_MASK = PAGE_SIZE - 1
+
+    ZERO_PAGES = {}         # Shared zero page for each type code
+
+    def __init__(self, size, typecode='H'):
+
+        if typecode not in PagedMemory.ZERO_PAGES:
+            PagedMemory.ZERO_PAGES[typecode] = array(typecode, [0] * PagedMemory.PAGE_SIZE)
+
+        count = (size + PagedMemory.PAGE_MASK) >> PagedMemory.PAGE_BITS
+
+        self.size = size
+        self.typecode = typecode
+        self.zero = PagedMemory.ZERO_PAGES[typecode]
+        self.pages = [self.zero] * count
+        self.generations = [0] * count
+        self.owned = [False] * count
+        self.generation = 0
+
+    # List interface.
+
+    def __len__(self):
+
+        return self.size
+
+    def __getitem__(self, addr):
+
+        if addr < 0 or addr >= self.size:
+            raise IndexError(f'memory address {addr} out of range')
+
+        page = addr >> PagedMemory.PAGE_BITS
+
+        if self.generations[page] != self.generation:
+            return 0
+
+        return self.pages[page][addr & PagedMemory.PAGE_MASK]
+
+    def __setitem__(self, addr, value):
+
+        if addr < 0 or addr >= self.size:
+            raise IndexError(f'memory address {addr} out of range')
+
+        page = addr >> PagedMemory.PAGE_BITS
+
+        if self.generations[page] != self.generation or not self.owned[page]:
+            self.own(page)
+
+        self.pages[page][addr & PagedMemory.PAGE_MASK] = value
+
+    def __iter__(self):
+
+        for page in range(len(self.pages)):
+            words = self.pages[page] if self.generations[page] == self.generation else self.zero
+            base = page << PagedMemory.PAGE_BITS
+            yield from words[:self.size - base]
+
+    # Make a page writable: start from zeros if it is from an older generation, or copy it
+    # if it is shared (the zero page, or a page shared with a forked memory).
+
+    def own(self, page):
+
+        if self.generations[page] != self.generation:
+            self.pages[page] = array(self.typecode, self.zero)
+            self.generations[page] = self.generation
+        else:
+            self.pages[page] = array(self.typecode, self.pages[page])
+
+        self.owned[page] = True
+
+    # Set every word to zero.
+
+    def clear(self):
+
+        self.generation += 1
+
+    # (address, value) of every non-zero word, in address order. Only looks at pages
+    # that have been written in the current generation.
+
+    def nonzero(self):
+
+        for page in range(len(self.pages)):
+            if self.generations[page] == self.generation and self.pages[page] is not self.zero:
+                base = page << PagedMemory.PAGE_BITS
+                for offset, value in enumerate(self.pages[page]):
+                    if value:
+                        yield (base + offset, value)
+
+    # A copy of the memory that shares all its pages with this one. Both memories copy a
+    # shared page the first time they write to it.
+
+    def fork(self):
+
+        copy = PagedMemory(self.size, self.typecode)
+        copy.pages = list(self.pages)
+        copy.generations = list(self.generations)
+        copy.generation = self.generation
+        self.owned = [False] * len(self.pages)
+
+        return copy
+
+    # copy.deepcopy() forks the memory instead of copying every page.
+
+    def __deepcopy__(self, memo):
+
+        return self.fork()
+
+    # Pickle only the pages written in the current generation.
+
+    def __getstate__(self):
+
+        pages = {page: self.pages[page].tobytes() for page in range(len(self.pages))
+                 if self.generations[page] == self.generation and self.pages[page] is not self.zero}
+
+        return {"size": self.size, "typecode": self.typecode, "pages": pages}
+
+    def __setstate__(self, state):
+
+        self.__init__(state["size"], state["typecode"])
+
+        for page, data in state["pages"].items():
+            words = array(self.typecode)
+            words.frombytes(data)
+            self.pages[page] = words
+            self.owned[page] = True
@@ -0,0 +1,178 @@
+#
+# Relay2Tetris netlist compiler. Turns a wired-up machine (a dictionary of components)
+# into integer signal slots and a flat signal vector, so that settling the hardware
+# does not have to hash signal names or build a new dictionary on every iteration.
+#
+# (C)2019 Robert Woodhead - trebor@animeigo.com
+# License: Creative Commons Attribution-NonCommercial-ShareAlike 4.0 International (CC BY-NC-SA 4.0)
+#
+
+from collections.abc import Mapping
+
+from Modules.Comp import Color
+
+import sys
+
+
+class Netlist(Mapping):
+    """ Compiled machine
+
+        names[slot] is the name of the signal in each slot; slots[name] is the reverse.
+        values[slot] is the current value of each signal (the signal vector).
+        sources[slot] is the index of the board driving each signal (None for TRUE/FALSE).
+        fanout[slot] is the tuple of board indexes that use the signal as input or power.
+        boards is the list of components, in the order of the machine dictionary.
+        dirty is the set of board indexes whose state was changed outside of settling.
+        order is the levelized evaluation order of the boards (see levelize()), and position[index]
+        is where each board is in it. feedback is True if there is a purely combinational loop.
+
+        Behaves like a read-only {signal: value} dictionary, so it can be passed anywhere
+        the signals dictionary used to go.
+    """
+
+    def __init__(self, machine):
+
+        self.boards = list(machine.values())
+        self.index = {board.name: index for index, board in enumerate(self.boards)}
+
+        # TRUE and FALSE are always available.
+
+        self.names = ["TRUE", "FALSE"]
+        self.values = [True, False]
+        self.sources = [None, None]
+
+        # Assign a slot to every output; each signal can only have one driver.
+
+        self.slots = {"TRUE": 0, "FALSE": 1}
+
+        for index, board in enumerate(self.boards):
+            for output in board.outputs.keys():
+                if output in self.slots:
+                    driver = "the system" if self.sources[self.slots[output]] is None else self.boards[self.sources[self.slots[output]]].name
+                    sys.exit(f'{Color.RED}# Error: Output signal {output} is being generated by both {board.name} and {driver}.{Color.END}')
+                self.slots[output] = len(self.names)
+                self.names.append(output)
+                self.values.append(board.outputs[output])
+                self.sources.append(index)
+
+        # Resolve the inputs and power sources of every board, and bind the boards to
+        # their slots.
+
+        fanout = [set() for _ in self.names]
+
+        for index, board in enumerate(self.boards):
+            for signal in board.inputs.keys():
+                if signal not in self.slots:
+                    sys.exit(f'{Color.RED}Error: Component [{board.name}] requires unknown input signal [{signal}]{Color.END}')
+                fanout[self.slots[signal]].add(index)
+
+            for signal in board.power.keys():
+                if signal not in self.slots:
+                    sys.exit(f'{Color.RED}Error: Component [{board.name}] requires unknown power signal [{signal}]{Color.END}')
+                fanout[self.slots[signal]].add(index)
+
+            board.bind(input_slots=[(signal, self.slots[signal]) for signal in board.inputs.keys()],
+                       power_slots=[(signal, self.slots[signal]) for signal in board.power.keys()],
+                       output_slots=[(signal, self.slots[signal]) for signal in board.outputs.keys()])
+
+        self.fanout = [tuple(sorted(boards)) for boards in fanout]
+
+        # Everything needs to be updated the first time the hardware settles.
+
+        self.dirty = set(range(len(self.boards)))
+
+        self.levelize()
+
+    # Sort the boards so that each one comes after the boards that drive its inputs.
+    # Loops in the datapath are broken at a stateful board (register, RAM...), whose
+    # outputs can then change during a tick that has it open, so the boards reading
+    # them may have to be updated again. A loop made only of combinational boards is
+    # a real feedback loop that cannot be levelized at all, and is flagged.
+
+    def levelize(self):
+
+        count = len(self.boards)
+        drivers = [set() for _ in range(count)]
+        readers = [set() for _ in range(count)]
+
+        for slot, boards in enumerate(self.fanout):
+            source = self.sources[slot]
+            if source is not None:
+                for reader in boards:
+                    if reader != source:
+                        drivers[reader].add(source)
+                        readers[source].add(reader)
+
+        waiting = [len(drivers[index]) for index in range(count)]
+        placed = [False] * count
+        ready = [index for index in range(count) if waiting[index] == 0]
+        order = []
+        feedback = False
+
+        while len(order) < count:
+
+            if ready:
+                index = min(ready)
+                ready.remove(index)
+            else:
+
+                # Stuck in a loop: break it at the stateful board with the fewest
+                # unplaced drivers, or at any board if the loop is combinational.
+
+                candidates = [index for index in range(count) if not placed[index] and self.boards[index].stateful]
+                if not candidates:
+                    feedback = True
+                    candidates = [index for index in range(count) if not placed[index]]
+                index = min(candidates, key=lambda index: (waiting[index], index))
+
+            placed[index] = True
+            order.append(index)
+
+            for reader in readers[index]:
+                waiting[reader] -= 1
+                if waiting[reader] == 0 and not placed[reader]:
+                    ready.append(reader)
+
+        self.order = order
+        self.position = [0] * count
+        for position, index in enumerate(order):
+            self.position[index] = position
+        self.feedback = feedback
+
+    # Mapping interface (signal name -> current value).
+
+    def __getitem__(self, name):
+
+        return self.values[self.slots[name]]
+
+    def __iter__(self):
+
+        return iter(self.names)
+
+    def __len__(self):
+
+        return len(self.names)
+
+    # Note that the internal state of some boards was changed outside of settling
+    # (clock ticks, RESET button, test script poking registers or RAM), so that
+    # event-driven settling knows it has to update them (even if they have no power).
+
+    def touch(self, *boards):
+
+        for board in boards:
+            self.boards[self.index[board]].dark = False
+
+        self.dirty.update(self.index[board] for board in boards)
+
+    # Signals as a {signal: value} dictionary, for traces and error reports. Either
+    # for a given signal vector, or for the current one with a list of (slot, value)
+    # changes undone.
+
+    def as_dict(self, values=None, changes=[]):
+
+        values = list(self.values if values is None else values)
+
+        for slot, value in changes:
+            values[slot] = value
+
+        return dict(zip(self.names, values))
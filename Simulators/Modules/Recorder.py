@@ -0,0 +1,313 @@
+#
+# Relay2Tetris signal recorder. Records the signal vector of the board-level machine after
+# every clock tick, keeping only the signals that changed, and streams it to a file in
+# compressed chunks of columns (one per signal): one bit per value for boolean signals, 16
+# bits for buses, and strings for text (the ASM line). A recording can be read back one tick
+# at a time, replayed on the terminal, or exported to a VCD file for a waveform viewer.
+#
+# File format: "R2TR", then length-prefixed zlib-compressed pickles. The first is the header
+# {names, sources, order, time, values} (signal names, their sources and display order, and
+# the initial time and signal vector); each of the others is a chunk {times, columns}, where
+# times is the clock time of each tick in the chunk, and columns[slot] is (ticks, kind, data,
+# off): the indexes in times of the ticks where the signal changed, and the values it changed
+# to, as packed bits (kind "bit"), an array('H') (kind "bus", with off the packed bits of the
+# ticks where the bus was off) or a list (kind "text").
+#
+# (C)2019 Robert Woodhead - trebor@animeigo.com
+# License: Creative Commons Attribution-NonCommercial-ShareAlike 4.0 International (CC BY-NC-SA 4.0)
+#
+
+from array import array
+
+import pickle
+import struct
+import zlib
+
+MAGIC = b"R2TR"
+
+
+class Recorder:
+    """ Signal recorder
+
+        file is the recording, last the signal vector as of the last tick recorded.
+        times is the clock time of each tick in the current chunk; ticks[slot] and values[slot]
+        are the ticks in the chunk where each signal changed, and the values it changed to.
+    """
+
+    CHUNK_TICKS = 4096      # Ticks per chunk written to the file
+
+    def __init__(self, path, names, values, time=0, sources=None, order=None):
+
+        self.file = open(path, "wb")
+        self.file.write(MAGIC)
+        self.last = list(values)
+        self.count = 0
+
+        write_block(self.file, {"names": list(names),
+                                "sources": sources,
+                                "order": order,
+                                "time": time,
+                                "values": self.last})
+
+        self.start_chunk()
+
+    def start_chunk(self):
+
+        self.times = array('L')
+        self.ticks = [[] for _ in self.last]
+        self.values = [[] for _ in self.last]
+
+    # Record the signal vector after a tick. 0 and False are different values here (a bus
+    # that is off is False).
+
+    def record(self, time, values):
+
+        last = self.last
+        tick = len(self.times)
+        self.times.append(time)
+
+        for slot, value in enumerate(values):
+            old = last[slot]
+            if value is not old and (value != old or type(value) is not type(old)):
+                self.ticks[slot].append(tick)
+                self.values[slot].append(value)
+                last[slot] = value
+
+        self.count += 1
+
+        if len(self.times) >= Recorder.CHUNK_TICKS:
+            self.flush()
+
+    # Write the current chunk to the file.
+
+    def flush(self):
+
+        if not self.times:
+            return
+
+        columns = {slot: (array('H', ticks),) + pack_column(self.values[slot])
+                   for slot, ticks in enumerate(self.ticks) if ticks}
+
+        write_block(self.file, {"times": self.times, "columns": columns})
+        self.file.flush()
+
+        self.start_chunk()
+
+    def close(self):
+
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+
+# -----------------------------
+# Columns
+# -----------------------------
+
+def pack_bits(bits):
+
+    packed = bytearray((len(bits) + 7) // 8)
+
+    for index, bit in enumerate(bits):
+        if bit:
+            packed[index >> 3] |= 1 << (index & 7)
+
+    return bytes(packed)
+
+
+def unpack_bits(packed, count):
+
+    return [bool(packed[index >> 3] >> (index & 7) & 1) for index in range(count)]
+
+
+# Pack the values a signal changed to into (kind, data, off).
+
+def pack_column(values):
+
+    if all(type(value) is bool for value in values):
+        return ("bit", pack_bits(values), None)
+
+    if all(type(value) is str for value in values):
+        return ("text", values, None)
+
+    off = [value is False or value is None for value in values]
+
+    return ("bus",
+            array('H', [0 if off[index] else int(value) & 0xFFFF for index, value in enumerate(values)]),
+            pack_bits(off) if any(off) else None)
+
+
+def unpack_column(kind, data, off, count):
+
+    if kind == "bit":
+        return unpack_bits(data, count)
+
+    if kind == "text":
+        return list(data)
+
+    values = list(data)
+
+    if off is not None:
+        for index, is_off in enumerate(unpack_bits(off, count)):
+            if is_off:
+                values[index] = False
+
+    return values
+
+
+# -----------------------------
+# File blocks
+# -----------------------------
+
+def write_block(file, data):
+
+    data = zlib.compress(pickle.dumps(data))
+    file.write(struct.pack("<I", len(data)))
+    file.write(data)
+
+
+def read_block(file):
+
+    size = file.read(4)
+
+    if len(size) < 4:
+        return None
+
+    return pickle.loads(zlib.decompress(file.read(struct.unpack("<I", size)[0])))
+
+
+# -----------------------------
+# Reading recordings
+# -----------------------------
+
+# Read the header of a recording (see the top of the file).
+
+def read_header(path):
+
+    with open(path, "rb") as file:
+        return open_recording(file)
+
+
+def open_recording(file):
+
+    if file.read(len(MAGIC)) != MAGIC:
+        raise ValueError(f'{file.name} is not a signal recording')
+
+    return read_block(file)
+
+
+# The changes in a recording, one tick at a time: (time, [(slot, value)...]).
+
+def changes(path):
+
+    with open(path, "rb") as file:
+
+        open_recording(file)
+
+        while True:
+
+            chunk = read_block(file)
+            if chunk is None:
+                return
+
+            ticks = [[] for _ in chunk["times"]]
+
+            for slot, (column, kind, data, off) in sorted(chunk["columns"].items()):
+                for tick, value in zip(column, unpack_column(kind, data, off, len(column))):
+                    ticks[tick].append((slot, value))
+
+            yield from zip(chunk["times"], ticks)
+
+
+# The signal vector after each tick in a recording: (time, values). The list of values
+# is updated in place, so make a copy to keep it.
+
+def frames(path):
+
+    values = list(read_header(path)["values"])
+
+    for time, changed in changes(path):
+        for slot, value in changed:
+            values[slot] = value
+        yield time, values
+
+
+# -----------------------------
+# VCD export
+# -----------------------------
+
+# Identifier of a signal in a VCD file: printable characters from ! to ~.
+
+def vcd_id(slot):
+
+    code = ""
+
+    while True:
+        code += chr(33 + slot % 94)
+        slot //= 94
+        if slot == 0:
+            return code
+
+
+def vcd_value(kind, value, code):
+
+    if kind == "bit":
+        return f'{1 if value else 0}{code}'
+
+    if kind == "text":
+        return f's{str(value).replace(" ", "_") or "_"} {code}'
+
+    if value is False or value is None:
+        return f'bz {code}'
+
+    return f'b{int(value) & 0xFFFF:b} {code}'
+
+
+# Export a recording to a VCD file. The time unit is one clock tick. A bus is a signal that
+# ever has an integer value; a bus that is off is high-impedance (z).
+
+def write_vcd(path, vcd_path, scope="relay2tetris"):
+
+    header = read_header(path)
+    names = header["names"]
+    kinds = [kind_of(value) for value in header["values"]]
+
+    for _, changed in changes(path):
+        for slot, value in changed:
+            if kinds[slot] == "bit" and kind_of(value) != "bit":
+                kinds[slot] = kind_of(value)
+
+    with open(vcd_path, "w") as vcd:
+
+        vcd.write("$version Relay2Tetris validate.py $end\n")
+        vcd.write("$timescale 1 ms $end\n")
+        vcd.write(f"$scope module {scope} $end\n")
+
+        for slot, name in enumerate(names):
+            if kinds[slot] == "bit":
+                vcd.write(f"$var wire 1 {vcd_id(slot)} {name} $end\n")
+            elif kinds[slot] == "bus":
+                vcd.write(f"$var wire 16 {vcd_id(slot)} {name} $end\n")
+            else:
+                vcd.write(f"$var string 1 {vcd_id(slot)} {name} $end\n")
+
+        vcd.write("$upscope $end\n$enddefinitions $end\n")
+
+        vcd.write(f"#{header['time']}\n$dumpvars\n")
+        for slot, value in enumerate(header["values"]):
+            vcd.write(vcd_value(kinds[slot], value, vcd_id(slot)) + "\n")
+        vcd.write("$end\n")
+
+        for time, changed in changes(path):
+            if changed:
+                vcd.write(f"#{time}\n")
+                for slot, value in changed:
+                    vcd.write(vcd_value(kinds[slot], value, vcd_id(slot)) + "\n")
+
+
+def kind_of(value):
+
+    if type(value) is bool or value is None:
+        return "bit"
+
+    return "text" if type(value) is str else "bus"
@@ -0,0 +1,117 @@
+#
+# Relay2Tetris control timeline. The control boards (the clock, the sequencer and the control
+# matrix: the clock and every board that only listens to control boards, RESET and constants)
+# go through the same states and produce the same control signals in every instruction cycle,
+# whatever the program does. The timeline keeps, for each state of the control boards (and of
+# RESET), what the next clock tick does to them: their new states and the control signals. It
+# is filled in by the full simulation of the first instruction cycle (and of the RESET cycle),
+# after which each tick takes the control signals from the timeline, and only the boards that
+# use them have to be settled.
+#
+# (C)2019 Robert Woodhead - trebor@animeigo.com
+# License: Creative Commons Attribution-NonCommercial-ShareAlike 4.0 International (CC BY-NC-SA 4.0)
+#
+
+from Modules.Comp import Reset
+
+
+class Timeline:
+    """ Control signal timeline
+
+        boards are the control boards, stateful the ones with state. external is the slots of
+        the other signals they use (RESET). outputs is the (slot, readers) of each control
+        signal, readers being the other boards that use it. entries[key] is (states, values):
+        the states of the stateful control boards and the control signals after the tick.
+        hits and misses count lookups.
+    """
+
+    def __init__(self, netlist, clock):
+
+        boards = netlist.boards
+        control = {netlist.index[clock.name]}
+        reset = {index for index, board in enumerate(boards) if isinstance(board, Reset)}
+
+        def sources(board):
+            return [netlist.sources[slot] for _, slot in board.input_slots + board.power_slots]
+
+        # Add the boards that listen to the control boards, and to nothing else but RESET and
+        # constants, until there are no more.
+
+        while True:
+            found = {index for index, board in enumerate(boards)
+                     if index not in control
+                     and any(source in control for source in sources(board))
+                     and all(source is None or source in control or source in reset for source in sources(board))}
+            if not found:
+                break
+            control |= found
+
+        self.clock = clock
+        self.boards = [boards[index] for index in sorted(control)]
+        self.stateful = [board for board in self.boards if board.stateful]
+
+        self.external = sorted({slot for board in self.boards for _, slot in board.input_slots + board.power_slots
+                                if netlist.sources[slot] is not None and netlist.sources[slot] not in control})
+
+        self.outputs = [(slot, tuple(reader for reader in netlist.fanout[slot] if reader not in control))
+                        for board in self.boards for _, slot in board.output_slots]
+
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    # The state of the control boards (for the clock, only whether it is high or low, not its
+    # running time).
+
+    def key(self, values):
+
+        return (tuple([values[slot] for slot in self.external]),
+                tuple(tuple(value for name, value in board.state.items() if name != "TIME") for board in self.stateful))
+
+    # Apply the tick for a key, if it is in the timeline: update the control boards, set the
+    # control signals, and mark the boards that use the ones that changed for settling.
+    # Returns True if it did.
+
+    def apply(self, key, netlist):
+
+        entry = self.entries.get(key)
+
+        if entry is None:
+            self.misses += 1
+            self.time = self.clock.state["TIME"]
+            return False
+
+        self.hits += 1
+        states, signals = entry
+
+        for board, state in zip(self.stateful, states):
+            board.state.update(state)
+
+        self.clock.state["TIME"] += 1
+
+        values = netlist.values
+        dirty = netlist.dirty
+
+        for (slot, readers), value in zip(self.outputs, signals):
+            old = values[slot]
+            if old != value or type(old) is not type(value):
+                values[slot] = value
+                dirty.update(readers)
+
+        for board in self.boards:
+            outputs = board.outputs
+            for output, slot in board.output_slots:
+                outputs[output] = values[slot]
+
+        return True
+
+    # Remember what a tick that wasn't in the timeline did to the control boards. Ticks that
+    # stop the clock (and reset its time) are not kept.
+
+    def store(self, key, netlist):
+
+        if self.clock.state["TIME"] != self.time + 1:
+            return
+
+        self.entries[key] = (tuple(tuple((name, value) for name, value in board.state.items() if name != "TIME") for board in self.stateful),
+                             tuple(netlist.values[slot] for slot, _ in self.outputs))
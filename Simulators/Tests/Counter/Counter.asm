@@ -0,0 +1,12 @@
+// Count forever in RAM[0]: the machine goes through the same states on every pass, except
+// for the value of RAM[0] read when A is set to 0 (checks that the tick cache stays bounded)
+//
+@1          // A=1 (so that the loop isn't at 0, and @LOOP doesn't read RAM[0])
+(LOOP)
+@0          // A=0
+M=M+1       // RAM[0] = RAM[0] + 1
+@LOOP       // Go back
+0;JMP
+//
+// Result: RAM[0] = the number of passes
+//
@@ -0,0 +1,13 @@
+// Counter loop test
+
+load Counter.asm,
+output-file Counter.out,
+compare-to Counter.cmp,
+output-list RAM[0]%D1.6.1;
+
+set RAM[0] 0;
+repeat 401 {
+  ticktock;
+}
+
+output;
@@ -0,0 +1,17 @@
+// Test a compute instruction that stores nothing and doesn't jump: it must not
+// change any register
+//
+@5          // A=5
+D=A         // D=5
+D+1         // Computes 6, but stores it nowhere
+@0          // A=0
+M=D         // RAM[0] = 5 (6 if D was changed)
+//
+// Tighter and detectable-in-hardware end loop
+//
+@END        // End program
+(END)
+0;JMP
+//
+// Result: RAM[0] = 5
+//
@@ -0,0 +1,12 @@
+// Compute instruction without a destination test
+
+load NoDest.asm,
+output-file NoDest.out,
+compare-to NoDest.cmp,
+output-list RAM[0]%D1.6.1;
+
+repeat 20 {
+  ticktock;
+}
+
+output;
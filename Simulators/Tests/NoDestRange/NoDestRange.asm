@@ -0,0 +1,14 @@
+// Test a compute instruction that uses M, but stores nothing and doesn't jump, with A
+// out of the range of RAM: it still reads M, so every engine must stop with an error
+//
+AD=-1       // A=65535, D=-1
+M-1         // Reads RAM[65535]: out of bounds
+//
+// Tighter and detectable-in-hardware end loop
+//
+@END        // End program
+(END)
+0;JMP
+//
+// Result: Error: RAM address [65535] is out of bounds!
+//
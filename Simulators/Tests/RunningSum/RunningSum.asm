@@ -0,0 +1,19 @@
+// Add RAM[0] to a running sum kept by the program, and store the sum in RAM[1]. The sum
+// carries over from one case of the test script to the next (so it can't be sharded)
+//
+@0          // D = RAM[0]
+D=M
+@sum        // sum = sum + RAM[0]
+M=D+M
+D=M         // RAM[1] = sum
+@1
+M=D
+//
+// Tighter and detectable-in-hardware end loop
+//
+@END        // End program
+(END)
+0;JMP
+//
+// Result: RAM[1] = the sum of RAM[0] over the cases run so far
+//
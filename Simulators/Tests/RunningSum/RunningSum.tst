@@ -0,0 +1,21 @@
+// Running sum test: the second case depends on what the program left in RAM in the first
+
+load RunningSum.asm,
+output-file RunningSum.out,
+compare-to RunningSum.cmp,
+output-list RAM[0]%D1.6.1 RAM[1]%D1.6.1;
+
+set RAM[0] 3,
+set RAM[1] 0;
+repeat 20 {
+  ticktock;
+}
+output;
+
+set PC 0,
+set RAM[0] 4,
+set RAM[1] 0;
+repeat 20 {
+  ticktock;
+}
+output;
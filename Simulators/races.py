@@ -0,0 +1,311 @@
+# --------------------------------------------------------------------------------------------
+# Hunt for races in the Relay2Tetris hardware. Runs a test in validate.py's simulator and, at
+# every clock tick, settles the hardware again under many random orders of the boards, with
+# each board seeing the updates of the boards before it (see settle_ordered() in validate.py),
+# the way relays switching at slightly different times would. If the hardware doesn't always
+# end up in the same state (signals, registers, RAM), the tick has a race: the outcome depends
+# on which relays switch first. The run itself goes on with the reference settling algorithm,
+# so it is the same in every process, and the ticks are shared among a pool of processes.
+#
+# Every race is reported with the signals and state that differ from the reference and the
+# seeds of the orders that produce them, and --tick T --seed S replays tick T with the order
+# from seed S and shows the result against the reference.
+#
+# Usage: python3 races.py [test name] {--orderings N} {--jobs N} {--settle random|event|levelized}
+#                         {--tick T --seed S}
+#
+# (C)2019 Robert Woodhead - trebor@animeigo.com
+# License: Creative Commons Attribution-NonCommercial-ShareAlike 4.0 International (CC BY-NC-SA 4.0)
+#
+# -------------------------------------------------------------------------------------------
+
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+
+from Modules.Comp import Color, RAM
+
+import validate
+
+import argparse
+import random
+import time
+import sys
+import os
+import io
+
+TESTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Tests')
+
+UNSETTLED = ("unsettled",)      # Outcome of an order that fails to settle
+
+
+# -----------------------------
+# Save and restore the state of the machine around a tick, so that it can be settled again
+# and again. Only what a tick can change is copied: the signal vector, and the state, inputs,
+# outputs and power of every board (RAM contents are forked, so they are copied on write).
+# -----------------------------
+
+def save_tick(netlist):
+
+    boards = [(board, dict(board.state), dict(board.inputs), dict(board.outputs), dict(board.power))
+              for board in netlist.boards]
+
+    memories = [(board, board.state["DATA"].fork(), board.state["WHEN"].fork(), board.count, set(board.written))
+                for board in netlist.boards if isinstance(board, RAM)]
+
+    return (list(netlist.values), boards, memories)
+
+
+# Restore the machine to a saved tick. The RAM written sets are left empty, so that the cells
+# written by the next tick can be found.
+
+def restore_tick(netlist, saved):
+
+    values, boards, memories = saved
+
+    netlist.values = list(values)
+    netlist.dirty = set()
+
+    for board, state, inputs, outputs, power in boards:
+        board.state = dict(state)
+        board.inputs = dict(inputs)
+        board.outputs = dict(outputs)
+        board.power = dict(power)
+        board.dark = False
+        if board.pure:
+            board.last = None
+
+    for board, data, when, count, written in memories:
+        board.state["DATA"] = data.fork()
+        board.state["WHEN"] = when.fork()
+        board.count = count
+        board.written.clear()
+
+
+# The state the hardware settled in: the signal vector, the state of the stateful boards,
+# and the RAM cells whose value changed (a cell written with the value it already had is
+# not a difference).
+
+def outcome(netlist, saved):
+
+    states = tuple((board.name, tuple(sorted((key, value) for key, value in board.state.items() if isinstance(value, (bool, int, str)))))
+                   for board in netlist.boards if board.stateful)
+
+    cells = tuple((board.name, tuple(sorted((addr, board.state["DATA"][addr]) for addr in board.written
+                                            if board.state["DATA"][addr] != data[addr])))
+                  for board, data, _, _, _ in saved[2])
+
+    return (tuple(netlist.values), states, cells)
+
+
+# What differs between an outcome and the reference, as a list of "NAME=value" strings.
+
+def differences(netlist, result, reference):
+
+    if result == UNSETTLED:
+        return ["does not settle"]
+
+    values, states, cells = result
+    ref_values, ref_states, ref_cells = reference
+
+    found = [f'{netlist.names[slot]}={validate.vfmt(value).strip()}'
+             for slot, value in enumerate(values) if value != ref_values[slot] or type(value) != type(ref_values[slot])]
+
+    for (name, state), (_, ref_state) in zip(states, ref_states):
+        ref_state = dict(ref_state)
+        found += [f'{name}.{key}={validate.vfmt(value).strip()}' for key, value in state if ref_state.get(key) != value]
+
+    for (name, written), (_, ref_written) in zip(cells, ref_cells):
+        ref_written = dict(ref_written)
+        found += [f'{name}[{addr}]={value:04x}' for addr, value in written if ref_written.get(addr) != value]
+
+    return found
+
+
+# -----------------------------
+# Run a test, exploring the ticks that belong to this worker (every jobs-th tick, starting
+# at worker + 1), or only tick [tick] if given. Returns a record with the races found.
+# Runs in a worker process.
+# -----------------------------
+
+def explore(name, worker=0, jobs=1, orderings=16, settle="event", tick=None, seeds=None, tests_path=TESTS):
+
+    validate.settle_mode = validate.SETTLE_MODES.index(settle)
+    seeds = range(orderings) if seeds is None else seeds
+
+    reference_tick = validate.tick
+    races = []
+    count = 0
+    explored = 0
+    cpu = None
+    message = None
+
+    # Tick the clock as validate.tick() does, but first try the tick with every seeded order.
+
+    def exploring_tick(machine, signals, clock, trace=validate.T_OFF):
+
+        nonlocal count, explored
+
+        if signals.dirty:
+            signals = validate.settle(machine=machine, signals=signals, trace=validate.T_OFF)
+
+        count += 1
+
+        if count != tick and (tick is not None or count % jobs != worker % jobs):
+            return reference_tick(machine=machine, signals=signals, clock=clock, trace=trace)
+
+        explored += 1
+        saved = save_tick(signals)
+        results = {}
+        shown = {}
+
+        for seed in seeds:
+            restore_tick(signals, saved)
+            clock.tick(signals)
+            try:
+                validate.settle_ordered(machine=machine, signals=signals, rng=random.Random(seed))
+                result = outcome(signals, saved)
+            except SystemExit:
+                result = UNSETTLED
+            results.setdefault(result, []).append(seed)
+            if tick is not None:
+                shown[seed] = signals.as_dict()
+
+        # Then run the tick for real.
+
+        restore_tick(signals, saved)
+        signals = reference_tick(machine=machine, signals=signals, clock=clock, trace=trace)
+        reference = outcome(signals, saved)
+
+        for board, _, _, _, written in saved[2]:
+            board.written.update(written)
+
+        if set(results) != {reference}:
+            races.append({"tick": count,
+                          "instruction": cpu.instr_count + 1 if cpu else 0,
+                          "pc": machine["PREV"].state["_PC"],
+                          "cycle": machine["SEQUENCER"].state["CYCLE"],
+                          "outcomes": [{"seeds": result_seeds, "differences": differences(signals, result, reference)}
+                                       for result, result_seeds in results.items() if result != reference],
+                          "reference": len(results.get(reference, [])),
+                          "signals": shown if tick is not None else None,
+                          "reference_signals": signals.as_dict() if tick is not None else None})
+
+        return signals
+
+    validate.tick = exploring_tick
+
+    start = time.perf_counter()
+    output = io.StringIO()
+
+    try:
+        with redirect_stdout(output):
+            asm, code, test, results = validate.load_test(os.path.join(tests_path, name), name)
+            cpu = validate.build_cpu(asm=asm, code=code, engine="board")
+            if test:
+                validate.run_script(cpu=cpu, test=test, results=results, trace=validate.T_OFF)
+            else:
+                cpu.run(sys.maxsize)
+
+    except SystemExit as exit:
+        message = str(exit.code) if exit.code else output.getvalue().strip().split("\n")[-1]
+
+    finally:
+        validate.tick = reference_tick
+
+    return {"worker": worker,
+            "races": races,
+            "ticks": count,
+            "explored": explored,
+            "message": message,
+            "time": time.perf_counter() - start}
+
+
+# -----------------------------
+# Reports.
+# -----------------------------
+
+def print_race(race):
+
+    count = len(race["outcomes"]) + (1 if race["reference"] else 0)
+
+    print(f'{Color.RED}Tick {race["tick"]} (instruction {race["instruction"]}, PC {race["pc"]}, cycle {race["cycle"]}): '
+          f'{count} outcome{"s" if count > 1 else ""}{"" if race["reference"] else ", none of them the reference"}{Color.END}')
+
+    if race["reference"]:
+        print(f'    reference                 {race["reference"]} orders')
+
+    for result in race["outcomes"]:
+        print(f'    seed {result["seeds"][0]:<6d} {len(result["seeds"]):3d} orders   {", ".join(result["differences"])}')
+
+
+# -----------------------------
+# Main program
+# -----------------------------
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Hunt for races in the Relay2Tetris hardware.")
+    parser.add_argument("test", help="Test name (subfolder of Tests folder)")
+    parser.add_argument("--orderings", type=int, default=16, metavar="N", help="Number of random board orders to try at each tick")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), metavar="N", help="Number of processes to share the ticks among")
+    parser.add_argument("--settle", choices=["random", "event", "levelized"], default="event", help="Settling algorithm for the run itself")
+    parser.add_argument("--tick", type=int, metavar="T", help="Only replay tick T (with --seed)")
+    parser.add_argument("--seed", type=int, metavar="S", help="Seed of the order to replay tick T with")
+    args = parser.parse_args()
+
+    if not os.path.isdir(os.path.join(TESTS, args.test)):
+        sys.exit(f'{Color.RED}# {args.test} : no such test.{Color.END}')
+
+    # Replay a single tick with a single order, and show it against the reference.
+
+    if args.tick is not None:
+
+        if args.seed is None:
+            sys.exit(f'{Color.RED}# --tick needs the --seed of the order to replay.{Color.END}')
+
+        record = explore(args.test, settle=args.settle, tick=args.tick, seeds=[args.seed])
+
+        if not record["races"]:
+            print(f'{Color.GREEN}# Tick {args.tick} settles the same with seed {args.seed} as with the reference.{Color.END}')
+            return
+
+        race = record["races"][0]
+        print(f'{Color.BOLD}# Reference:{Color.END}')
+        validate.print_state(race["reference_signals"])
+        print(f'{Color.BOLD}# Seed {args.seed} (differences highlighted):{Color.END}')
+        validate.print_state(race["signals"][args.seed], race["reference_signals"])
+        print_race(race)
+        sys.exit(1)
+
+    jobs = max(1, args.jobs)
+
+    print(f'{Color.BOLD}# Trying {args.orderings} orders at every tick of {args.test}, in {jobs} processes.{Color.END}')
+
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        records = list(pool.map(explore, [args.test] * jobs, range(jobs), [jobs] * jobs, [args.orderings] * jobs, [args.settle] * jobs))
+
+    races = sorted((race for record in records for race in record["races"]), key=lambda race: race["tick"])
+
+    for race in races:
+        print_race(race)
+
+    messages = {record["message"] for record in records if record["message"]}
+
+    for message in messages:
+        print(f'{Color.YELLOW}# The test stopped: {message}{Color.END}')
+
+    explored = sum(record["explored"] for record in records)
+    color = Color.RED if races else Color.GREEN
+
+    print(f'{color}# {len(races)} of {explored} ticks have races ({explored * args.orderings} orders tried in {time.perf_counter() - start:.2f}s).{Color.END}')
+
+    if races:
+        print(f'{Color.YELLOW}# Replay one with: python3 races.py {args.test} --tick T --seed S{Color.END}')
+
+    sys.exit(1 if races else 0)
+
+
+if __name__ == "__main__":
+    main()
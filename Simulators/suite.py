@@ -0,0 +1,186 @@
+# --------------------------------------------------------------------------------------------
+# Run the whole Relay2Tetris test suite: every folder in the Tests folder (or the ones named
+# on the command line) is run by validate.py's simulator on a pool of processes, one test per
+# core. A test that fails is recorded instead of ending the run, and at the end there is a
+# summary with the wall time, instructions and clock ticks for each test, and a JUnit XML
+# report for CI tools.
+#
+# Usage: python3 suite.py {test names} {--engine board|isa|jit} {--settle random|event|levelized|ordered}
+#                         {--cosim N} {--memo N} {--jobs N} {--junit FILE}
+#
+# (C)2019 Robert Woodhead - trebor@animeigo.com
+# License: Creative Commons Attribution-NonCommercial-ShareAlike 4.0 International (CC BY-NC-SA 4.0)
+#
+# -------------------------------------------------------------------------------------------
+
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from xml.etree import ElementTree
+
+from Modules.Comp import Color
+
+import validate
+
+import argparse
+import traceback
+import time
+import sys
+import os
+import io
+
+TESTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Tests')
+
+
+# -----------------------------
+# Find the tests: every folder in the Tests folder with a .hack file of the same name.
+# -----------------------------
+
+def find_tests(tests_path=TESTS):
+
+    return sorted(name for name in os.listdir(tests_path)
+                  if os.path.isfile(os.path.join(tests_path, name, f'{name}.hack')))
+
+
+# -----------------------------
+# Run one test, and return its result record. Runs in a worker process. Everything the
+# simulator prints is captured, and the reason for a failure is the message it exited
+# with, or the last thing it printed. With a tick cache (memo), the test also fails if the
+# cache ends up holding more ticks than it may.
+# -----------------------------
+
+def run_test(name, engine="board", settle="event", cosim=0, memo=0, tests_path=TESTS):
+
+    validate.settle_mode = validate.SETTLE_MODES.index(settle)
+
+    output = io.StringIO()
+    status = "passed"
+    message = ""
+    error = None
+    cpu = None
+    start = time.perf_counter()
+
+    try:
+        with redirect_stdout(output):
+            asm, code, test, results = validate.load_test(os.path.join(tests_path, name), name)
+            error = validate.load_error(os.path.join(tests_path, name), name)
+            cpu = validate.build_cpu(asm=asm, code=code, engine=engine, cosim=cosim)
+            if memo:
+                validate.start_memo(cpu, memo)
+            if test:
+                validate.validate(cpu=cpu, test=test, results=results, trace=validate.T_OFF)
+            else:
+                cpu.run(sys.maxsize)
+
+    except SystemExit as exit:
+        status = "failed"
+        message = str(exit.code) if exit.code else output.getvalue().strip().split("\n")[-1]
+        if error is not None and validate.uncolor(message) == error:
+            status = "passed"
+            message = ""
+
+    except Exception:
+        status = "error"
+        message = traceback.format_exc().strip().split("\n")[-1]
+        output.write(traceback.format_exc())
+
+    else:
+        if error is not None:
+            status = "failed"
+            message = f'The run should have stopped with "{error}".'
+        elif memo and sum(len(variants) for variants in validate.memo.entries.values()) > memo:
+            status = "failed"
+            message = f'The tick cache holds more than {memo} ticks.'
+
+    return {"name": name,
+            "status": status,
+            "message": validate.uncolor(message),
+            "time": time.perf_counter() - start,
+            "instructions": cpu.instr_count if cpu else 0,
+            "ticks": getattr(cpu, "ticks", None),
+            "output": validate.uncolor(output.getvalue())}
+
+
+# -----------------------------
+# Reports.
+# -----------------------------
+
+def print_summary(records, wall_time):
+
+    print(f'{Color.BOLD}{"Test":16s} {"Result":8s} {"Time":>8s} {"Instructions":>13s} {"Ticks":>10s}{Color.END}')
+
+    for record in records:
+        color = Color.GREEN if record["status"] == "passed" else Color.RED
+        ticks = "" if record["ticks"] is None else f'{record["ticks"]:10d}'
+        print(f'{record["name"]:16s} {color}{record["status"]:8s}{Color.END} {record["time"]:7.2f}s '
+              f'{record["instructions"]:13d} {ticks:>10s}')
+        if record["status"] != "passed":
+            print(f'{Color.RED}    {record["message"]}{Color.END}')
+
+    passed = len([record for record in records if record["status"] == "passed"])
+    total = sum(record["time"] for record in records)
+    color = Color.GREEN if passed == len(records) else Color.RED
+
+    print(f'{color}# {passed} of {len(records)} tests passed in {wall_time:.2f}s ({total:.2f}s of test time).{Color.END}')
+
+
+def write_junit(records, wall_time, path, suite_name):
+
+    suite = ElementTree.Element("testsuite",
+                                name=suite_name,
+                                tests=str(len(records)),
+                                failures=str(len([record for record in records if record["status"] == "failed"])),
+                                errors=str(len([record for record in records if record["status"] == "error"])),
+                                time=f'{wall_time:.3f}')
+
+    for record in records:
+        case = ElementTree.SubElement(suite, "testcase", classname=suite_name, name=record["name"], time=f'{record["time"]:.3f}')
+        if record["status"] == "failed":
+            ElementTree.SubElement(case, "failure", message=record["message"]).text = record["output"]
+        elif record["status"] == "error":
+            ElementTree.SubElement(case, "error", message=record["message"]).text = record["output"]
+
+    suites = ElementTree.Element("testsuites")
+    suites.append(suite)
+
+    ElementTree.ElementTree(suites).write(path, encoding="utf-8", xml_declaration=True)
+
+
+# -----------------------------
+# Main program
+# -----------------------------
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Run the Relay2Tetris test suite.")
+    parser.add_argument("tests", nargs="*", help="Tests to run (default: all of the folders in the Tests folder)")
+    parser.add_argument("--engine", choices=["board", "isa", "jit"], default="board", help="Engine to run the tests on")
+    parser.add_argument("--settle", choices=validate.SETTLE_MODES, default="event", help="Settling algorithm for the board engine")
+    parser.add_argument("--cosim", type=int, default=0, metavar="N", help="Check the boards against the HACK CPU every N instructions")
+    parser.add_argument("--memo", type=int, default=0, metavar="N", help="Run the board engine with a cache of N clock ticks")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), metavar="N", help="Number of tests to run at the same time")
+    parser.add_argument("--junit", default="suite.xml", metavar="FILE", help="JUnit XML report file")
+    args = parser.parse_args()
+
+    tests = args.tests if args.tests else find_tests()
+
+    for name in tests:
+        if not os.path.isdir(os.path.join(TESTS, name)):
+            sys.exit(f'{Color.RED}# {name} : no such test.{Color.END}')
+
+    print(f'{Color.BOLD}# Running {len(tests)} tests on the {args.engine} engine, {min(args.jobs, len(tests))} at a time.{Color.END}')
+
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=max(1, min(args.jobs, len(tests)))) as pool:
+        records = list(pool.map(run_test, tests, [args.engine] * len(tests), [args.settle] * len(tests), [args.cosim] * len(tests), [args.memo] * len(tests)))
+
+    wall_time = time.perf_counter() - start
+
+    print_summary(records, wall_time)
+    write_junit(records, wall_time, args.junit, f'Relay2Tetris.{args.engine}')
+
+    sys.exit(0 if all(record["status"] == "passed" for record in records) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,16 +5,22 @@
 # signals. This will make debugging a lot easier.
 #
 # Usage: python3 validate.py [Test name (subfolder of Tests folder)] {{Trace Level: [N]one|[I]nstruction|[C]lock|[S]ettle}}}
+#                            {--engine board|isa|jit} {--cosim N} {--save FILE} {--restore FILE} {--shard N} {--settle random|event|levelized|ordered}
+#                            {--record FILE} {--vcd FILE} {--flight N} {--profile FILE} {--memo N} {--pure N}
+#                            {--no-timeline} {--switch COND} {--board N} {--batch}
+#        python3 validate.py --replay FILE
 #
-# Test folder [xxx] will contain up to 4 files.
+# Test folder [xxx] will contain up to 5 files.
 #
 #   [xxx].hack      The machine code source file (output of the Nand2Tetris assembler) - required
 #   [xxx].asm       Human-readable source code (input to the Nand2Tetris assembler)
 #   [xxx].tst       Validation test script (input to the Nand2Tetris emulator)
 #   [xxx].cmp       Validation comparison results
+#   [xxx].err       The error the run must stop with, for tests of programs that go wrong
 #
 # If [xxx].tst is present, the validator runs the test script and compares the output to the
-# contents of the [xxx].cmp file. If not, the validator just runs the machine code.
+# contents of the [xxx].cmp file. If not, the validator just runs the machine code. If
+# [xxx].err is present, the test passes if (and only if) the run stops with that error.
 #
 # To make parsing simpler, there is a restriction on the test scripts: there can be only
 # one output-list, and the formatting is ignored.
@@ -23,13 +29,110 @@
 # files in the test folder, and these files need to be loaded before the script is executed.
 #
 # For convenience, the validator recognizes when the machine has entered the infinite-loop
-# end condition and exits script repeat loops early in this situation.
+# end condition and exits script repeat loops early in this situation. More generally, in a
+# repeat loop that only runs the machine (ticktock), it remembers the state of the machine
+# (PC, A, D and the RAM cells written during the loop) at the end of each pass, and if the
+# machine gets back to an earlier state, it is in a cycle (an idle loop, or busy-waiting):
+# the rest of the loop is skipped, except for the few passes needed to end up at the same
+# point in the cycle. Not done when co-simulating, where every instruction is checked.
+#
+# The test script is compiled into a plan when it is loaded (see compile_script()), so it is
+# only parsed once. On the isa and jit engines (and when co-simulating), a repeat loop that
+# only runs the machine is a single run of the engine for all of its instructions.
 #
 # The default trace level is [I]nstruction, which provides machine state at the start of
 # each instruction cycle. [C]lock lets you see the internal state of all signals at
 # each machine clock. [S]ettle shows that plus the process of settling on the hardware
 # state. [N]one just reports the results of the validation.
 #
+# Once the hardware is wired up, it is compiled into a netlist (see Modules/Netlist.py): every
+# signal gets an integer slot in a flat signal vector, unknown signals and signals with multiple
+# drivers are caught right away, and the boards read their inputs straight from the vector.
+#
+# The --settle option chooses how the hardware settles after each clock tick. The default
+# (random) updates every board in random order until nothing changes, which is the reference
+# mode for hunting races. The event mode uses the netlist's fanout index to only update the
+# boards whose inputs actually changed, which is a lot faster because most boards are idle on
+# most ticks. The levelized mode also sorts the boards so that each one comes after the boards
+# driving it, breaking datapath loops at the registers, so most ticks settle in a single pass;
+# it only iterates when a change feeds back through an open register (and falls back to the
+# event mode if the hardware has a purely combinational loop). The ordered mode is like the
+# random mode, but each board sees the updates of the boards before it, so that the order can
+# change the result if the design has a race (see races.py).
+#
+# In all the modes, a board that has no power is only updated again once it gets power (or
+# is changed from outside), since its outputs are off whatever its inputs are.
+#
+# In the event and levelized modes, the clock, sequencer and control matrix are only simulated
+# in full during the first instruction cycle: what each tick does to them is kept in a timeline
+# (see Modules/Timeline.py), which then sets the control signals directly, so that only the
+# boards that use them are settled. --no-timeline simulates them on every tick.
+#
+# In all the modes, settling watches for oscillations: if the signals come back to a state
+# they were already in, the hardware is in a limit cycle and will never settle, so instead
+# of giving up after 10 iterations it stops right away, and lists the signals that oscillate,
+# the boards that drive them, and the feedback loop they form.
+#
+# The --engine option chooses what runs the program. The default (board) simulates the
+# boards. The isa engine (see Modules/Hack.py) just executes the HACK instructions, which is
+# much faster but does not validate the hardware; it runs the same test scripts through the
+# same interface (pc, peek/poke, step, run, halted), and only has the [N]one and [I]nstruction
+# trace levels. The jit engine (see Modules/Jit.py) does the same, but compiles the program
+# into Python functions one basic block at a time, which pays off on long-running programs.
+#
+# The --cosim N option runs the isa engine in lockstep with the boards, and every N instructions
+# checks that PC, A, D and the RAM cells either of them wrote since the last check agree. The
+# first divergence is reported with the instruction and both machine states, so the hardware
+# design can be checked against the HACK CPU without a .cmp file.
+#
+# --switch COND runs the program on the isa or jit engine until COND becomes true (pc=N,
+# count=N, ram[N] for a change, ram[N]=V), then moves PC, A, D and RAM into the boards and
+# goes on there, with tracing (see Switching). --board N moves back to the isa or jit engine
+# after N instructions on the boards, until a condition becomes true again.
+#
+# --save FILE writes a checkpoint of the complete machine (see snapshot()) when the run ends,
+# even if the test fails, and --restore FILE starts from a checkpoint instead of a new
+# machine (the engine is the one that was saved), so a late failure can be examined without
+# running everything before it again.
+#
+# --shard N splits test scripts made of independent cases (each restarting the program with
+# "set PC", like Mult.tst) at those restarts, and runs the cases in N processes, each from a
+# copy of the freshly reset machine. The outputs are merged in order and checked against
+# the .cmp rows of each case. The cases must not depend on each other: a script is only split
+# if each case sets all the RAM cells that the cases before it set (and the ones it outputs),
+# and gets the same results on a HACK CPU after the cases before it as on a fresh one (so it
+# doesn't read cells the program wrote in an earlier case). --batch has the same rules.
+#
+# --batch runs the same cases in one process, on a batch of HACK CPUs held in NumPy arrays
+# (see Modules/Batch.py) that executes each instruction on all of them at once. The cases
+# must have the same steps. Only this option needs NumPy.
+#
+# --record FILE records every signal after every clock tick (see Modules/Recorder.py), which
+# is much faster than the [C]lock trace level since only the changes are stored, in binary.
+# --vcd FILE exports the recording to a VCD file for a waveform viewer, and --replay FILE
+# prints a recording tick by tick like the [C]lock trace level.
+#
+# The board engine always runs with a flight recorder, which keeps the last 32 instructions
+# (--flight N to change, 0 to turn it off) and the signals after the last few clock ticks.
+# They are only printed if the run fails (wrong output, hardware failing to settle...).
+#
+# --profile FILE writes a JSON report of the run: how many times each board (and each class
+# of board) was updated and how long that took, a histogram of the number of iterations it
+# took to settle the hardware, and the number of instructions and clock ticks per second.
+#
+# --memo N caches up to N clock ticks (see Modules/Memo.py): what a tick does, keyed by the
+# signal vector and board states before it, and the RAM cells it read (a few ticks per state).
+# When the machine is back in a cached state, the tick is applied without settling the
+# hardware. This only helps when the whole machine repeats; loops that change a register on
+# every pass miss.
+#
+# --pure N caches the outputs of the pure components (the ALU, multiplexers, incrementor,
+# branch checker and decoder, whose outputs only depend on their inputs), for up to N input
+# patterns per class (see refresh_pure() in Modules/Comp.py). A pure component isn't updated
+# again if its inputs haven't changed. This mostly saves updates in the random and ordered
+# modes, which update every board in every iteration, but not time: the components are so
+# simple that the lookups cost about as much as computing the outputs.
+#
 # IMPORTANT: According to Shimon Schocken, the correct hardware behavior when an instruction
 # updates AREG *and* executes a branch is that the branch should go to the value in
 # AREG at the start of the instruction, not the new value computed by the instruction.
@@ -42,10 +145,29 @@
 
 from Modules.Comp import Reset, Clock, Sequencer, Matrix, ROM, RAM, Mocked
 from Modules.Comp import Register, Decoder, Multiplexer, ALU, Incrementor, Branch, ConditionCodes
-from Modules.Comp import Color
+from Modules.Comp import Color, set_pure_caching, pure_stats
+from Modules.Netlist import Netlist
+from Modules.Hack import Hack
+from Modules.Jit import Jit
+from Modules.Batch import Batch
+from Modules.Recorder import Recorder, read_header, frames, write_vcd
+from Modules.Memo import TickCache
+from Modules.Timeline import Timeline
 
 # from Modules.Test import Script
 
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque, Counter
+from contextlib import redirect_stdout
+from array import array
+
+import argparse
+import pickle
+import json
+import time
+import copy
+import zlib
+import io
 import random
 import sys
 import os
@@ -54,15 +176,47 @@ import re
 ps_sources = {}     # global print_state sources list
 ps_order = []       # global print_state signal ordering
 
-term_rows, term_columns = [int(x) for x in os.popen('stty size', 'r').read().split()]
+# Terminal size, for formatting the machine state (with a default when not running in a
+# terminal, e.g. in the test suite runner).
+
+try:
+    term_rows, term_columns = [int(x) for x in os.popen('stty size 2>/dev/null', 'r').read().split()]
+except ValueError:
+    term_rows, term_columns = 50, 200
 
 T_OFF = 0       # No debug trace, just give results
 T_ON = 1        # Instruction-by-Instruction tracing
 T_FULL = 2      # Tick-by-tick tracing
 T_SETTLE = 3    # Trace settling of hardware state
 
+S_RANDOM = 0    # Update all boards in random order until settled
+S_EVENT = 1     # Only update boards whose inputs changed
+S_LEVEL = 2     # Update boards whose inputs changed in levelized order, in one pass
+S_ORDERED = 3   # Update all boards in random order, each seeing the updates before it
+
+SETTLE_MODES = ["random", "event", "levelized", "ordered"]     # Names of the settle modes, for options
+
 USAGE = True    # Print usage of signals for power computations
 
+MAX_LOOP_CELLS = 64     # Most RAM cells a repeat loop can write and still be checked for cycles
+
+settle_mode = S_RANDOM
+
+WATCH_AFTER = 2     # Settling iterations before watching for oscillations (most ticks take fewer)
+
+recorder = None     # Recorder for the signals after every clock tick (see --record)
+
+FLIGHT_INSTRUCTIONS = 32    # Instructions kept by the flight recorder (see --flight)
+FLIGHT_TICKS = 10           # Clock ticks of signals kept by the flight recorder
+
+profile = None      # Profiler for the boards and settling (see --profile)
+
+memo = None         # Cache of settled clock ticks (see --memo)
+
+pure_caching = False    # Caching the outputs of pure components (see --pure)
+
+timeline = None     # Timeline of the control signals (see --no-timeline)
+
 
 # Load and parse all the test files, return assembly, code, script and results
 
@@ -129,6 +283,7 @@ def load_test(test_path, test_name):
             script = [line.strip() for line in script]                                # Remove leading and trailing spaces, punctuation
             script = [line.lower() for line in script if line != ""]                  # Remove empty lines, lowercase remainder
             print(f'# Read test script in {test_file} : {len(script)} commands.')
+            script = compile_script(script)
     else:
         script = None
 
@@ -152,60 +307,138 @@ def load_test(test_path, test_name):
     return asm, code, script, results
 
 
-# Gather state of all the outputs of all the hardware. We always have TRUE and FALSE
-# signals.
+# Load the error a test must stop with (the first line of [xxx].err), or None.
 
-def state_of(machine):
+def load_error(test_path, test_name):
 
-    signals = {"TRUE": True, "FALSE": False}
+    error_file = os.path.join(test_path, f'{test_name}.err')
 
-    for board in machine.values():
-        for output in board.outputs.keys():
-            if output in signals:
-                sys.exit(f'{Color.RED}# Error: Output signal {output} is being generated by multiple boards (incl. {board.name})!{Color.END}')
-            else:
-                signals[output] = board.outputs[output]
+    if not os.path.isfile(error_file):
+        return None
 
-    return signals
+    with open(error_file, 'r') as f:
+        error = f.readline().strip()
+        print(f'# Read expected error in {error_file} : {error}')
 
+    return error
 
-# Gather state of all the outputs of all the hardware. This version is only
-# run once, and also generates the dictionary of sources and signal order
-# list that are stashed in ps_sources and ps_order for the convenience of
-# the print_state() function.
 
-def initial_state_of(machine):
+# Remove the color codes from text.
 
-    # True and False are always available
+def uncolor(text):
 
-    signals = {"TRUE": True, "FALSE": False}
-    sources = {"TRUE": "", "FALSE": ""}
-    sequence = {"TRUE": 9999, "FALSE": 9999}
-    inputs = []
+    return re.sub("\033\\[[0-9;]*m", "", text)
 
-    for board in machine.values():
-        inputs.extend(board.inputs.keys())
-        inputs.extend(board.power.keys())
-        for output in board.outputs.keys():
-            if output in signals:
-                sys.exit(f'{Color.RED}# Error1: Output signal {output} is being generated by both {board.name} and {str(sources[output])}.{Color.END}')
-            else:
-                signals[output] = board.outputs[output]
-                sources[output] = board.name
-                sequence[output] = board.sequence
+
+# Compile the test script commands into a plan, so that the script is only parsed once and
+# loops are run without looking at the commands again. The plan is a list of steps:
+#
+#   ("ignore", line)                    load, output-file and compare-to
+#   ("output-list", names, refs)        names as in the results header, refs parsed
+#   ("set", ref, value)
+#   ("repeat", count, plan, ticks)      ticks is the number of ticktocks in the plan if that
+#   ("ticktock",)                       is all there is in it (None otherwise)
+#   ("output",)
+#
+# where a ref is "pc" or ("ram", address).
+
+def compile_script(script):
+
+    plan, _ = compile_block(script, 0, 0)
+
+    return plan
+
+
+# Compile the commands from line start to the end of the enclosing repeat loop (depth > 0)
+# or of the script. Returns the plan and the line it stopped at.
+
+def compile_block(script, start, depth):
+
+    plan = []
+    line_no = start
+
+    while line_no < len(script):
+
+        line = script[line_no]
+        tokens = line.split()
+        cmd = tokens[0]
+
+        if cmd == "load" or cmd == "output-file" or cmd == "compare-to":
+            plan.append(("ignore", line))
+        elif cmd == "output-list":
+            plan.append(("output-list", tokens[1:], [var_parse(token) for token in tokens[1:]]))
+        elif cmd == "set":
+            plan.append(("set", var_parse(tokens[1]), int(tokens[2]) & 0xFFFF))
+        elif cmd == "repeat":
+            body, line_no = compile_block(script, line_no + 1, depth + 1)
+            ticks = len(body) if body and all(step == ("ticktock",) for step in body) else None
+            plan.append(("repeat", int(tokens[1]), body, ticks))
+        elif cmd == "}":
+            if depth == 0:
+                sys.exit(f'{Color.RED}Error: Empty stack.{Color.END}')
+            return plan, line_no
+        elif cmd == "ticktock":
+            plan.append(("ticktock",))
+        elif cmd == "output":
+            plan.append(("output",))
+        else:
+            sys.exit(f'{Color.RED}Unknown script command: {line}{Color.END}')
+
+        line_no += 1
+
+    if depth > 0:
+        sys.exit(f'{Color.RED}Error: Unterminated repeat loop.{Color.END}')
+
+    return plan, line_no
+
+
+# Parse a variable reference into components. Currently only understands RAM[x] and PC.
+
+def var_parse(ref):
+
+    if ref == "pc":
+        return ref
+
+    regex = re.search(r"(.+?)\[(-*[0-9]+?)\]", ref)
+
+    if not regex:
+        sys.exit(f'{Color.RED}Error: Malformed or unknown variable {ref}.{Color.END}')
+    if regex.group(1) != "ram":
+        sys.exit(f'{Color.RED}Error: Unknown variable {ref}.{Color.END}')
+    if int(regex.group(2)) >= RAM.SIZE:
+        sys.exit(f'{Color.RED}Error: RAM[{regex.group(2)}] is out of range.{Color.END}')
+
+    return (regex.group(1), int(regex.group(2)))
+
+
+# Generate the dictionary of signal sources and the signal order list from the
+# compiled netlist. This is only run once, and the results are stashed in
+# ps_sources and ps_order for the convenience of the print_state() function.
+
+def initial_state_of(netlist):
+
+    sources = {}
+    sequence = {}
+
+    for slot, signal in enumerate(netlist.names):
+        if netlist.sources[slot] is None:               # TRUE and FALSE
+            sources[signal] = ""
+            sequence[signal] = 9999
+        else:
+            sources[signal] = netlist.boards[netlist.sources[slot]].name
+            sequence[signal] = netlist.boards[netlist.sources[slot]].sequence
 
     ignorable = ['TRUE', 'FALSE', 'RESET', '~RESET', 'ASM', 'PREV']
 
-    for output in signals.keys():
-        if output not in inputs and output not in ignorable:
-            print(f'{Color.YELLOW}# Warning: Unused output {output} generated by {sources[output]}.')
+    for slot, signal in enumerate(netlist.names):
+        if not netlist.fanout[slot] and signal not in ignorable:
+            print(f'{Color.YELLOW}# Warning: Unused output {signal} generated by {sources[signal]}.')
 
-    order = [(sequence[k], k) for k in signals.keys()]
+    order = [(sequence[k], k) for k in netlist.names]
     order.sort()
     order = [item[1] for item in order]
 
-    return (signals,
-            sources,
+    return (sources,
             order)
 
 
@@ -313,7 +546,7 @@ def print_machine(machine, signals):
     pc = machine["PC"].state["DATA"]
     a = machine["AREG"].state["DATA"]
     d = machine["DREG"].state["DATA"]
-    m = machine["RAM"].state["DATA"][a]
+    m = machine["RAM"].state["DATA"][a] if a < RAM.SIZE else 0      # (A can be out of range)
 
     # display windows
 
@@ -327,7 +560,7 @@ def print_machine(machine, signals):
     blank = " "*len(machine["ROM"].state["SYMB"][0])
     rom = [f'{x:5d} {machine["ROM"].state["ROM"][x]:016b} {vfmt(machine["ROM"].state["ASM"][x])}' for x in range(rom_lo, rom_hi)]
 
-    recent = [(when, addr) for addr, when in enumerate(machine["RAM"].state["WHEN"]) if when > 0]
+    recent = [(when, addr) for addr, when in machine["RAM"].state["WHEN"].nonzero()]
     recent.sort(reverse=True)
     recent = recent[:W_FULL]
     recent = [addr for when, addr in recent]
@@ -398,19 +631,134 @@ def print_machine(machine, signals):
     print('')
 
 
+# -----------------------------
+# Oscillation detection. While the hardware settles, keeps a hash of the signal vector
+# (updated from the changes of each iteration) together with the boards still to update,
+# and if the same state comes back, the hardware is in a limit cycle and will never settle,
+# so there is no point in going on. The report lists the signals that oscillate, the boards
+# driving them, and the feedback loop they form.
+# -----------------------------
+
+class Oscillation:
+    """ Limit cycle detector for one settle
+
+        hash is the hash of the changes made to the signal vector since the start, history the
+        list of changes [(slot, old value)...] made by each iteration, and seen[(hash, pending)]
+        the last iteration after which the hardware was in that state.
+    """
+
+    def __init__(self, pending=()):
+
+        self.hash = 0
+        self.history = []
+        self.seen = {(0, frozenset(pending)): 0}
+
+    # Note the changes made by an iteration, with the boards left to update. Returns the
+    # iteration where the cycle started if the hardware is back in an earlier state.
+
+    def step(self, values, changes, pending=()):
+
+        for slot, old in changes:
+            self.hash ^= hash((slot, old)) ^ hash((slot, values[slot]))
+
+        self.history.append(changes)
+
+        key = (self.hash, frozenset(pending))
+        start = self.seen.get(key)
+        self.seen[key] = len(self.history)
+
+        return start if start is not None and self.repeats(values, start) else None
+
+    # True if the signal vector is really the same as it was after iteration start (not just
+    # the same hash): every signal changed since then is back to its value at the time.
+
+    def repeats(self, values, start):
+
+        first = {}
+
+        for changes in self.history[start:]:
+            for slot, old in changes:
+                first.setdefault(slot, old)
+
+        return all(old == values[slot] and type(old) is type(values[slot]) for slot, old in first.items())
+
+    # Report the oscillation that started after iteration start, and exit.
+
+    def report(self, netlist, start):
+
+        cycle = self.history[start:]
+        slots = sorted({slot for changes in cycle for slot, _ in changes})
+        drivers = {netlist.sources[slot] for slot in slots}
+
+        print(f'{Color.RED}# The hardware oscillates between {len(cycle)} states; these signals never settle:{Color.END}')
+
+        for slot in slots:
+            values = [old for changes in cycle for changed, old in changes if changed == slot]
+            readers = [netlist.boards[index].name for index in netlist.fanout[slot] if index in drivers]
+            print(f'{Color.RED}#   {netlist.names[slot]:10s} driven by {netlist.boards[netlist.sources[slot]].name:10s} '
+                  f'{" -> ".join(vfmt(value).strip() for value in values)}'
+                  f'{" (read by " + ", ".join(readers) + ")" if readers else ""}{Color.END}')
+
+        loop = feedback_loop(netlist, slots, drivers)
+
+        if loop:
+            print(f'{Color.RED}# Feedback loop: {" -> ".join(netlist.boards[index].name for index in loop + loop[:1])}{Color.END}')
+
+        sys.exit(f'{Color.RED}# Error: Hardware failed to settle!{Color.END}')
+
+
+# Find a loop among the boards driving the oscillating signals: a list of boards, each of
+# which reads an oscillating signal driven by the one before it (and the first reads one
+# driven by the last). Empty if there isn't one.
+
+def feedback_loop(netlist, slots, drivers):
+
+    edges = {index: sorted({reader for slot in slots if netlist.sources[slot] == index
+                            for reader in netlist.fanout[slot] if reader in drivers}) for index in drivers}
+
+    for first in sorted(drivers):
+        path = [first]
+        visited = {first}
+        while True:
+            following = [index for index in edges[path[-1]] if index == first or index not in visited]
+            if not following:
+                break
+            if first in following:
+                return path
+            path.append(following[0])
+            visited.add(following[0])
+
+    return []
+
+
 # Update the state of hardware modules in random order until they
-# settle on a stable configuration.
+# settle on a stable configuration. signals is the compiled netlist
+# of the machine; every board sees the signal vector as it was at the
+# start of each iteration.
 
 def settle(machine, signals, trace=T_OFF):
 
+    if settle_mode == S_EVENT or (settle_mode == S_LEVEL and signals.feedback):
+        return settle_event(machine=machine, signals=signals, trace=trace)
+    elif settle_mode == S_LEVEL:
+        return settle_levelized(machine=machine, signals=signals, trace=trace)
+    elif settle_mode == S_ORDERED:
+        return settle_ordered(machine=machine, signals=signals, trace=trace)
+
+    netlist = signals
+    netlist.dirty.clear()                   # Everything gets updated anyway.
+
     settled = False                         # We are not settled yet.
     settle_time = 0                         # Number of settling iterations.
-    order = [board for board in machine]    # The boards in the machine.
-    initial_signals = signals
+    order = list(range(len(netlist.boards)))    # The boards in the machine.
+    values = netlist.values
+    initial_values = values
 
     if trace == T_SETTLE:
         print(f'Settle(0): Cycle={machine["SEQUENCER"].state["CYCLE"]}')
-        print_state(signals)
+        print_state(netlist.as_dict())
+
+    watch = None                            # Oscillation detector, once settling takes a while.
 
     # Try to settle the hardware, but give up after a while.
 
@@ -422,34 +770,280 @@ def settle(machine, signals, trace=T_OFF):
         random.shuffle(order)
         settle_time += 1
 
-        for board in order:
-            machine[board].update(signals)
+        new_values = values[:]
 
-        new_signals = state_of(machine)
+        for index in order:
+            board = netlist.boards[index]
+            board.refresh(values)
+            outputs = board.outputs
+            for output, slot in board.output_slots:
+                new_values[slot] = outputs[output]
 
         if trace == T_SETTLE:
-            print(f'Settle({settle_time}): Cycle={machine["SEQUENCER"].state["CYCLE"]} - {", ".join([machine[x].name for x in order])}')
+            print(f'Settle({settle_time}): Cycle={machine["SEQUENCER"].state["CYCLE"]} - {", ".join([netlist.boards[x].name for x in order])}')
             print('')
-            print_state(new_signals, signals)
+            print_state(netlist.as_dict(new_values), netlist.as_dict(values))
 
-        if new_signals == signals:
+        if new_values == values:
             settled = True
         else:
-            old_signals = signals
-            signals = new_signals
+            old_values = values
+            values = new_values
+            if settle_time >= WATCH_AFTER:
+                start = watch.step(values, [(slot, old) for slot, old in enumerate(old_values) if old != values[slot] or type(old) is not type(values[slot])]) if watch else None
+                watch = watch or Oscillation()
+                if start is not None:
+                    netlist.values = values
+                    watch.report(netlist, start)
+
+    netlist.values = new_values
 
     if trace >= T_FULL:
         print(f'Settled: Cycle={machine["SEQUENCER"].state["CYCLE"]}')
-        print_state(new_signals, initial_signals)
+        print_state(netlist.as_dict(), netlist.as_dict(initial_values))
 
 # If we failed to settle, it's a hardware problem! :)
 
     if not settled:
-        print(new_signals)
-        print(old_signals)
+        print(netlist.as_dict(new_values))
+        print(netlist.as_dict(old_values))
+        sys.exit(f'{Color.RED}# Error: Hardware failed to settle!{Color.END}')
+
+    if profile is not None:
+        profile.settles[settle_time] += 1
+
+    return netlist
+
+
+# Event-driven version of settle(). Each iteration only updates the boards that
+# were touched or whose inputs or power changed in the previous iteration, using
+# the netlist fanout index. As in settle(), all the boards updated in an iteration
+# see the signal vector as it was at the start of the iteration, so the results
+# are identical.
+
+def settle_event(machine, signals, trace=T_OFF):
+
+    netlist = signals
+    boards = netlist.boards
+    fanout = netlist.fanout
+    values = netlist.values
+
+    settle_time = 0                         # Number of settling iterations.
+    pending = netlist.dirty                 # Boards that need to be updated.
+    netlist.dirty = set()
+    watch = None                            # Oscillation detector, once settling takes a while.
+
+    if trace >= T_FULL:
+        initial_signals = netlist.as_dict()
+
+    if trace == T_SETTLE:
+        print(f'Settle(0): Cycle={machine["SEQUENCER"].state["CYCLE"]}')
+        print_state(initial_signals)
+
+    # Try to settle the hardware, but give up after a while.
+
+    while pending and settle_time < 10:
+
+        settle_time += 1
+        updates = []
+
+        for index in pending:
+            board = boards[index]
+            board.refresh(values)
+            outputs = board.outputs
+            for output, slot in board.output_slots:
+                updates.append((slot, outputs[output]))
+
+        updated = pending
+        pending = set()
+        changes = []
+
+        for slot, value in updates:
+            old = values[slot]
+            if old != value or type(old) != type(value):
+                pending.update(fanout[slot])    # False -> 0 is a change too, as far as traces are concerned.
+                changes.append((slot, old))
+            values[slot] = value
+
+        if trace == T_SETTLE:
+            print(f'Settle({settle_time}): Cycle={machine["SEQUENCER"].state["CYCLE"]} - {", ".join([boards[x].name for x in updated])}')
+            print('')
+            print_state(netlist.as_dict(), netlist.as_dict(changes=changes))
+
+        if pending and settle_time >= WATCH_AFTER:
+            start = watch.step(values, changes, pending) if watch else None
+            watch = watch or Oscillation(pending)
+            if start is not None:
+                watch.report(netlist, start)
+
+    if trace >= T_FULL:
+        print(f'Settled: Cycle={machine["SEQUENCER"].state["CYCLE"]}')
+        print_state(netlist.as_dict(), initial_signals)
+
+    # If we failed to settle, it's a hardware problem! :)
+
+    if pending:
+        print(netlist.as_dict())
+        print(netlist.as_dict(changes=changes))
+        sys.exit(f'{Color.RED}# Error: Hardware failed to settle!{Color.END}')
+
+    if profile is not None:
+        profile.settles[settle_time] += 1
+
+    return netlist
+
+
+# Levelized version of settle(). The boards are updated in the netlist's levelized
+# order, and each board sees the signals updated by the boards before it, so when
+# there are no loops every board only needs to be updated once. Only the boards that
+# were touched or whose inputs changed are updated. If a board changes a signal used
+# by a board that is earlier in the order (a feedback path through an open register),
+# that board is updated again in another pass.
+
+def settle_levelized(machine, signals, trace=T_OFF):
+
+    netlist = signals
+    boards = netlist.boards
+    fanout = netlist.fanout
+    position = netlist.position
+    values = netlist.values
+
+    settle_time = 0                         # Number of settling passes.
+    pending = netlist.dirty                 # Boards that need to be updated.
+    netlist.dirty = set()
+    watch = None                            # Oscillation detector, once settling takes a while.
+
+    if trace >= T_FULL:
+        initial_signals = netlist.as_dict()
+
+    if trace == T_SETTLE:
+        print(f'Settle(0): Cycle={machine["SEQUENCER"].state["CYCLE"]}')
+        print_state(initial_signals)
+
+    # Try to settle the hardware, but give up after a while.
+
+    while pending and settle_time < 10:
+
+        settle_time += 1
+        current = pending                   # Boards to update in this pass...
+        pending = set()                     # ...and in the next one.
+        updated = []
+        changes = []
+
+        for index in netlist.order:
+
+            if index not in current:
+                continue
+
+            board = boards[index]
+            board.refresh(values)
+            outputs = board.outputs
+            updated.append(index)
+            here = position[index]
+
+            for output, slot in board.output_slots:
+                value = outputs[output]
+                old = values[slot]
+                if old != value or type(old) != type(value):
+                    changes.append((slot, old))
+                    for reader in fanout[slot]:
+                        if position[reader] > here:
+                            current.add(reader)
+                        else:
+                            pending.add(reader)
+                values[slot] = value
+
+        if trace == T_SETTLE:
+            print(f'Settle({settle_time}): Cycle={machine["SEQUENCER"].state["CYCLE"]} - {", ".join([boards[x].name for x in updated])}')
+            print('')
+            print_state(netlist.as_dict(), netlist.as_dict(changes=changes))
+
+        if pending and settle_time >= WATCH_AFTER:
+            start = watch.step(values, changes, pending) if watch else None
+            watch = watch or Oscillation(pending)
+            if start is not None:
+                watch.report(netlist, start)
+
+    if trace >= T_FULL:
+        print(f'Settled: Cycle={machine["SEQUENCER"].state["CYCLE"]}')
+        print_state(netlist.as_dict(), initial_signals)
+
+    # If we failed to settle, it's a hardware problem! :)
+
+    if pending:
+        print(netlist.as_dict())
+        print(netlist.as_dict(changes=changes))
+        sys.exit(f'{Color.RED}# Error: Hardware failed to settle!{Color.END}')
+
+    if profile is not None:
+        profile.settles[settle_time] += 1
+
+    return netlist
+
+
+# Ordered version of settle(). As in settle(), every board is updated in random order
+# until nothing changes, but each board sees the signals updated by the boards before it,
+# the way relays that switch at slightly different times would. In settle(), the order makes
+# no difference (every board sees the signals as they were at the start of the iteration);
+# here it does, so a design with a race can settle differently depending on the order (see
+# races.py, which tries many orders with seeded random generators, passed as rng). Since
+# the order changes from one iteration to the next, there is no oscillation detection.
+
+def settle_ordered(machine, signals, trace=T_OFF, rng=random):
+
+    netlist = signals
+    boards = netlist.boards
+    values = netlist.values
+    netlist.dirty.clear()                   # Everything gets updated anyway.
+
+    settled = False                         # We are not settled yet.
+    settle_time = 0                         # Number of settling iterations.
+    order = list(range(len(boards)))        # The boards in the machine.
+
+    if trace >= T_FULL:
+        initial_signals = netlist.as_dict()
+
+    # Try to settle the hardware, but give up after a while.
+
+    while not settled and settle_time < 10:
+
+        rng.shuffle(order)
+        settle_time += 1
+        changes = []
+
+        for index in order:
+            board = boards[index]
+            board.refresh(values)
+            outputs = board.outputs
+            for output, slot in board.output_slots:
+                value = outputs[output]
+                old = values[slot]
+                if old != value or type(old) != type(value):
+                    changes.append((slot, old))
+                    values[slot] = value
+
+        if trace == T_SETTLE:
+            print(f'Settle({settle_time}): Cycle={machine["SEQUENCER"].state["CYCLE"]} - {", ".join([boards[x].name for x in order])}')
+            print('')
+            print_state(netlist.as_dict(), netlist.as_dict(changes=changes))
+
+        settled = not changes
+
+    if trace >= T_FULL:
+        print(f'Settled: Cycle={machine["SEQUENCER"].state["CYCLE"]}')
+        print_state(netlist.as_dict(), initial_signals)
+
+    # If we failed to settle, it's a hardware problem! :)
+
+    if not settled:
+        print(netlist.as_dict())
+        print(netlist.as_dict(changes=changes))
         sys.exit(f'{Color.RED}# Error: Hardware failed to settle!{Color.END}')
 
-    return new_signals
+    if profile is not None:
+        profile.settles[settle_time] += 1
+
+    return netlist
 
 
 # -----------------------------
@@ -458,9 +1052,54 @@ def settle(machine, signals, trace=T_OFF):
 
 def tick(machine, signals, clock, trace=T_OFF):
 
+    # Settle any changes made from outside since the last tick (test script setting
+    # RAM or PC, RESET button) before the clock edge, so that they don't race it.
+
+    if signals.dirty:
+        signals = settle(machine=machine, signals=signals, trace=T_OFF)
+
+    # If the machine has been in this state before, the tick can come from the cache (not
+    # when tracing the clock ticks, which shows the settling).
+
+    if memo is not None and trace < T_FULL:
+        key = memo.key(signals)
+        if not memo.apply(key, signals):
+            memo.start()
+            signals = clock_edge(machine=machine, signals=signals, clock=clock, trace=trace)
+            memo.store(key, signals)
+    else:
+        signals = clock_edge(machine=machine, signals=signals, clock=clock, trace=trace)
+
+    if recorder is not None:
+        recorder.record(clock.state["TIME"], signals.values)
+
+    if flight is not None:
+        flight.ticks.append((clock.state["TIME"], tuple(signals.values)))
+
+    return signals
+
+
+# Tick the clock and settle the hardware. In the event and levelized modes, the control
+# signals come from the timeline when it has them (not when tracing the clock ticks, which
+# shows the control boards settling), and only the boards that use them are settled.
+
+def clock_edge(machine, signals, clock, trace=T_OFF):
+
+    if timeline is not None and trace < T_FULL and settle_mode in (S_EVENT, S_LEVEL):
+        key = timeline.key(signals.values)
+        if timeline.apply(key, signals):
+            return settle(machine=machine, signals=signals, trace=trace)
+    else:
+        key = None
+
     clock.tick(signals)
+    signals.touch(clock.name)
+    signals = settle(machine=machine, signals=signals, trace=trace)
 
-    return settle(machine=machine, signals=signals, trace=trace)
+    if key is not None:
+        timeline.store(key, signals)
+
+    return signals
 
 
 # -----------------------------
@@ -483,6 +1122,9 @@ def cycle(machine, signals, clock, instr_count=0, trace=T_OFF):
     prev["_RESET"] = machine["RESET"].state["RESET"]
     prev["_M"] = machine["INM"].state["DATA"]
 
+    if flight is not None:
+        flight.record(machine, instr_count)
+
     # Run through the clock ticks in a cycle.
 
     for t in range(machine["SEQUENCER"].state["TICKS"]):
@@ -491,149 +1133,772 @@ def cycle(machine, signals, clock, instr_count=0, trace=T_OFF):
     return signals, instr_count + 1
 
 
-# -----------------------------
-# Run the test.
-# -----------------------------
+# -----------------------------------------------------------------------------------
+# Flight recorder: always keeps the last few instructions and clock ticks of the board-level
+# machine, cheaply (a tuple each), and only prints them when something goes wrong, so that
+# runs with the [N]one trace level still have some context when they fail.
+# -----------------------------------------------------------------------------------
 
-def validate(machine, signals, test, results, trace):
+class FlightRecorder:
+    """ Flight recorder
 
-    # Parse a variable reference into components. Currently only
-    # understands RAM[x] and PC.
+        instructions holds (instruction number, PC, A, D, M, source line) at the start of each
+        of the last instructions, ticks holds (time, signal vector) after each of the last ticks.
+    """
 
-    def var_parse(ref):
+    def __init__(self, instructions=FLIGHT_INSTRUCTIONS, ticks=FLIGHT_TICKS):
 
-        if ref == "pc":
-            return ref
-        else:
-            regex = re.search(r"(.+?)\[(-*[0-9]+?)\]", ref)
-            if regex:
-                return (regex.group(1), int(regex.group(2)))
-            else:
-                sys.exit(f'{Color.RED}Error: Malformed or unknown variable {ref}.{Color.END}')
+        self.instructions = deque(maxlen=instructions)
+        self.ticks = deque(maxlen=ticks)
 
-    # Get a variable's value.
+    def clear(self):
 
-    def var_get(ref):
+        self.instructions.clear()
+        self.ticks.clear()
 
-        if isinstance(ref, str):
-            if ref == "pc":
-                return machine["PC"].outputs["PC"]
-            else:
-                sys.exit(f'{Color.RED}Error: Unknown variable {ref}.{Color.END}')
-        else:
-            if ref[0] == "ram":
-                ram = machine["RAM"].state["DATA"]
-                if ref[1] < len(ram):
-                    value = ram[ref[1]]
-                    return value - 65536 if value > 32757 else value    # 2's complement
-                else:
-                    sys.exit(f'{Color.RED}Error: RAM[{ref[1]}] is out of range.{Color.END}')
-            else:
-                sys.exit(f'{Color.RED}Error: Unknown variable {ref}.{Color.END}')
+    def record(self, machine, instr_count):
 
-    # Set a variable's value.
+        pc = machine["PC"].state["DATA"]
+        a = machine["AREG"].state["DATA"]
+        rom = machine["ROM"].state
 
-    def var_set(ref, value):
+        self.instructions.append((instr_count,
+                                  pc,
+                                  a,
+                                  machine["DREG"].state["DATA"],
+                                  machine["RAM"].state["DATA"][a] if a < RAM.SIZE else None,
+                                  rom["ASM"][pc] if pc < len(rom["ASM"]) else ""))
 
-        value = int(value) & 0xFFFF
+    # Print what the recorder has, and the machine as it is now.
 
-        if isinstance(ref, str):
-            if ref == "pc":
-                machine["PC"].state["DATA"] = value
-                print(f'{Color.GREEN}Set: PC = {value}')
-            else:
-                sys.exit(f'{Color.RED}Error: Unknown variable {ref}.{Color.END}')
-        else:
-            if ref[0] == "ram":
-                ram = machine["RAM"].state["DATA"]
-                if ref[1] < len(ram):
-                    ram[ref[1]] = value                         # Set value
-                    machine["RAM"].state["WHEN"][ref[1]] = 1    # Mark as visited
-                    print(f'{Color.GREEN}Set: RAM[{ref[1]}] = {value}{Color.END}')
-                else:
-                    sys.exit(f'{Color.RED}Error: RAM[{ref[1]}] is out of range.{Color.END}')
-            else:
-                sys.exit(f'{Color.RED}Error: Unknown variable {ref}.{Color.END}')
+    def dump(self, board):
 
-    # Run through the test script.
+        if not self.instructions and not self.ticks:
+            return
 
-    test_pc = 0
-    output_list = []
-    output = []
-    stack = []
-    instr_count = 1
+        print(f'{Color.YELLOW}# Flight recorder: the last {len(self.instructions)} instructions{Color.END}')
+        print(f'{Color.BOLD}{"Instr":>8s} {"PC":>6s} {"A":>6s} {"D":>6s} {"M":>6s}  Source{Color.END}')
 
-    while (test_pc < len(test)):
+        for instr_count, pc, a, d, m, asm in self.instructions:
+            print(f'{instr_count:8d} {pc:6d} {a:6d} {d:6d} {"" if m is None else m:>6}  {vfmt(asm)}')
 
-        line = test[test_pc]
-        tokens = line.split()
-        cmd = tokens[0].lower()
+        print('')
+        print(f'{Color.YELLOW}# Flight recorder: the signals after the last {len(self.ticks)} clock ticks{Color.END}')
 
-        if cmd == "load" or cmd == "output-file" or cmd == "compare-to":
+        previous = None
 
-            print(f'{Color.YELLOW}Ignored: {line}{Color.END}')
+        for time, values in self.ticks:
+            signals = dict(zip(board.signals.names, values))
+            print(f'{Color.GREEN}Clock tick {time}:{Color.END}')
+            print_state(signals, previous)
+            previous = signals
 
-        elif cmd == "output-list":
+        print(f'{Color.YELLOW}# Flight recorder: the machine when it stopped{Color.END}')
+        print_state(board.signals.as_dict(), previous)
+        print_machine(machine=board.machine, signals=board.signals)
 
-            output_list = tokens[1:]
-            if output_list != results[0]:
-                sys.exit(f'{Color.RED}Error: output-list {output_list} does not match results {results[0]}.{Color.END}')
-            output = [output_list]
-            output_list = [var_parse(token) for token in output_list]
-            print(f'{Color.GREEN}Output List: {output_list}{Color.END}')
 
-        elif cmd == "set":
+flight = FlightRecorder()
 
-            var_set(var_parse(tokens[1]), tokens[2])
 
-        elif cmd == "repeat":
+# Dump the flight recorder, if the CPU is (or includes) the board-level machine.
 
-            stack.append([test_pc, int(tokens[1])])
-            print(f'{Color.GREEN}Repeat {tokens[1]} times:{Color.END}')
+def dump_flight(cpu):
 
-        elif cmd == "}":
+    board = cpu.board if isinstance(cpu, Lockstep) or (isinstance(cpu, Switching) and cpu.on_board) else cpu
 
-            # Check to see if we are in a halt condition (looping on same instruction).
-            # If so, pop the innermost loop.
+    if flight is not None and isinstance(board, Board):
+        flight.dump(board)
 
-            if machine["PC"].state["DATA"] == machine["PREV"].state["_PC"]:
-                stack.pop()
-                print(f'{Color.YELLOW}Program Halt detected, exiting loop.{Color.END}')
-            elif stack == []:
-                sys.exit(f'{Color.RED}Error: Empty stack.{Color.END}')
-            elif stack[-1][1] > 1:
-                stack[-1][1] -= 1
-                test_pc = stack[-1][0]
-            else:
-                stack.pop()
 
-        elif cmd == "ticktock":
+# -----------------------------------------------------------------------------------
+# Board-level machine, as wired up by setup_v1() or setup_v2(). Presents the same
+# interface to the test harness as the instruction-level Hack CPU (Modules/Hack.py).
+# -----------------------------------------------------------------------------------
 
-            signals, instr_count = cycle(machine=machine, signals=signals, clock=clock, instr_count=instr_count, trace=trace)
+class Board:
+    """ Board-level machine
 
-        elif cmd == "output":
+        machine, signals and clock are as returned by the setup functions.
+        instr_count is the number of instructions executed since RESET was released.
+        prev_pc is the PC at the start of the last instruction.
+    """
 
-            values = [str(signed(var_get(item))) for item in output_list]
-            output.append(values)
-            if len(output) <= len(results):
-                expected = results[len(output)-1]
-                if values != expected:
-                    print(f'{Color.RED}Output   : {values}{Color.END}')
-                    print(f'{Color.RED}Expected : {expected}{Color.END}')
-                    sys.exit()
-                else:
-                    print(f'{Color.GREEN}Output correct: {values}{Color.END}')
-            else:
-                print(f'{Color.RED}Output   : {values}{Color.END}')
-                sys.exit(f'{Color.RED}More outputs than test results{Color.END}')
+    RAM_SIZE = RAM.SIZE
 
-        else:
+    def __init__(self, machine, signals, clock):
 
-            sys.exit(f'{Color.RED}Unknown script command: {line}{Color.END}')
+        self.machine = machine
+        self.signals = signals
+        self.clock = clock
+        self.instr_count = 0
+        self.prev_pc = -1
 
-        test_pc += 1
+    # Registers.
 
-    print(f'{Color.GREEN}# SCRIPT VALIDATED CORRECTLY!{Color.END}')
+    @property
+    def pc(self):
+
+        return self.machine["PC"].state["DATA"]
+
+    @pc.setter
+    def pc(self, value):
+
+        self.machine["PC"].state["DATA"] = value
+        self.signals.touch("PC")
+
+    @property
+    def a(self):
+
+        return self.machine["AREG"].state["DATA"]
+
+    @property
+    def d(self):
+
+        return self.machine["DREG"].state["DATA"]
+
+    # Clock ticks so far.
+
+    @property
+    def ticks(self):
+
+        return self.clock.state["TIME"]
+
+    # RAM addresses written by the program since last cleared.
+
+    @property
+    def written(self):
+
+        return self.machine["RAM"].written
+
+    # Test script interface: read and write RAM.
+
+    def peek(self, addr):
+
+        return self.machine["RAM"].state["DATA"][addr]
+
+    def poke(self, addr, value):
+
+        self.machine["RAM"].state["DATA"][addr] = value & 0xFFFF
+        self.machine["RAM"].state["WHEN"][addr] = 1         # Mark as visited
+        self.signals.touch("RAM")
+
+    # Drop the RESET line (setup raises it).
+
+    def release(self):
+
+        self.machine["RESET"].clr()
+        self.signals.touch("RESET")
+        self.prev_pc = -1
+        self.instr_count = 0
+
+    # Take over the registers, RAM and instruction count of another CPU (see Switching). The
+    # boards must be at the start of an instruction. The registers' gates are closed at that
+    # point, so their outputs are set along with their state (once the changes still pending,
+    # such as dropping RESET, have powered them up).
+
+    def load(self, cpu):
+
+        if self.signals.dirty:
+            self.signals = settle(machine=self.machine, signals=self.signals, trace=T_OFF)
+
+        for name, value in (("PC", cpu.pc), ("AREG", cpu.a), ("DREG", cpu.d)):
+            register = self.machine[name]
+            register.state["DATA"] = value
+            register.outputs[register.output] = value
+            self.signals.touch(name)
+
+        ram = self.machine["RAM"]
+        data = ram.state["DATA"]
+        when = ram.state["WHEN"]
+        data.clear()
+        when.clear()
+
+        for addr in range(self.RAM_SIZE):
+            value = cpu.peek(addr)
+            if value:
+                data[addr] = value
+                when[addr] = 1          # Mark as visited
+
+        ram.written.clear()
+        self.signals.touch("RAM")
+        self.prev_pc = cpu.prev_pc
+        self.instr_count = cpu.instr_count
+
+    # True if the last instruction jumped to itself (the HACK end-of-program idiom).
+
+    def halted(self):
+
+        return self.pc == self.prev_pc
+
+    # Execute one instruction.
+
+    def step(self, trace=T_OFF):
+
+        self.prev_pc = self.pc
+        self.signals, _ = cycle(machine=self.machine, signals=self.signals, clock=self.clock,
+                                instr_count=self.instr_count + 1, trace=trace)
+        self.instr_count += 1
+
+    # Execute up to count instructions, stopping early if the program halts (but always
+    # executing at least one). Returns the number of instructions executed.
+
+    def run(self, count):
+
+        executed = 0
+
+        while executed < count:
+            self.step()
+            executed += 1
+            if self.halted():
+                break
+
+        return executed
+
+
+# -----------------------------------------------------------------------------------
+# Lockstep co-simulation: runs the board-level machine and the instruction-level HACK CPU
+# side by side, and every [every] instructions compares PC, A, D and the RAM cells that
+# either of them wrote since the last check. Stops at the first divergence.
+# -----------------------------------------------------------------------------------
+
+class Lockstep:
+    """ Board-level machine checked against the instruction-level HACK CPU
+
+        board is the Board, isa the Hack CPU, every the number of instructions between checks.
+    """
+
+    RAM_SIZE = RAM.SIZE
+
+    def __init__(self, board, isa, every=1):
+
+        self.board = board
+        self.isa = isa
+        self.every = every
+        self.pending = 0                        # Instructions executed since the last check
+        self.first = board.instr_count + 1      # Number of the first of them
+
+        board.written.clear()
+
+    @property
+    def instr_count(self):
+
+        return self.board.instr_count
+
+    @property
+    def ticks(self):
+
+        return self.board.ticks
+
+    # Registers come from the board; setting PC sets both.
+
+    @property
+    def pc(self):
+
+        return self.board.pc
+
+    @pc.setter
+    def pc(self, value):
+
+        self.board.pc = value
+        self.isa.pc = value
+
+    # Test script interface: read and write RAM. Reads come from the board, after
+    # making sure the two machines still agree.
+
+    def peek(self, addr):
+
+        if self.pending:
+            self.check()
+
+        return self.board.peek(addr)
+
+    def poke(self, addr, value):
+
+        self.board.poke(addr, value)
+        self.isa.poke(addr, value)
+
+    def halted(self):
+
+        return self.board.halted()
+
+    # Execute one instruction on both machines.
+
+    def step(self, trace=T_OFF):
+
+        self.board.step(trace)
+        self.isa.step()
+
+        self.pending += 1
+
+        if self.pending >= self.every or self.board.halted():
+            self.check()
+
+    def run(self, count):
+
+        executed = 0
+
+        while executed < count:
+            self.step()
+            executed += 1
+            if self.halted():
+                break
+
+        return executed
+
+    # Compare the machines, and report the first divergence.
+
+    def check(self):
+
+        board = self.board
+        isa = self.isa
+
+        diffs = [(reg, getattr(board, reg), getattr(isa, reg)) for reg in ("pc", "a", "d")
+                 if getattr(board, reg) != getattr(isa, reg)]
+
+        for addr in sorted(board.written | isa.written):
+            if board.peek(addr) != isa.peek(addr):
+                diffs.append((f'RAM[{addr}]', board.peek(addr), isa.peek(addr)))
+
+        if diffs:
+            last = board.instr_count
+            where = f'instruction {last}' if self.first == last else f'instructions {self.first}-{last}'
+            asm = isa.asm[isa.prev_pc] if isa.asm and 0 <= isa.prev_pc < len(isa.asm) else ""
+            print(f'{Color.RED}Divergence between board and ISA after {where}, last at PC = {isa.prev_pc}  {asm}{Color.END}')
+            print(f'{"":12s} {"Board":>7s} {"ISA":>7s}')
+            for reg in ("pc", "a", "d"):
+                print(f'{reg.upper():12s} {getattr(board, reg):7d} {getattr(isa, reg):7d}')
+            for name, board_value, isa_value in diffs:
+                print(f'{Color.RED}{name.upper():12s} {board_value:7d} {isa_value:7d}{Color.END}')
+            sys.exit(f'{Color.RED}# Error: Board-level machine does not match the HACK CPU!{Color.END}')
+
+        board.written.clear()
+        isa.written.clear()
+        self.pending = 0
+        self.first = board.instr_count + 1
+
+
+# -----------------------------------------------------------------------------------
+# Multi-fidelity execution: runs the program on the instruction-level HACK CPU (isa or jit)
+# until a condition becomes true, then moves PC, A, D and RAM into the board-level machine
+# and goes on there, tick by tick, with tracing. After a given number of instructions on the
+# boards it can move the state back and fast-forward again, until the next condition.
+# -----------------------------------------------------------------------------------
+
+# Parse a switching condition: "pc=N" (the next instruction is at N), "count=N" (N instructions
+# executed), "ram[N]" (RAM[N] changes) or "ram[N]=V" (RAM[N] holds V). Returns (kind, number,
+# value), value being None for a change.
+
+def parse_condition(text):
+
+    match = re.fullmatch(r'\s*(pc|count)\s*=\s*(-?\d+)\s*|\s*ram\s*\[\s*(\d+)\s*\]\s*(?:=\s*(-?\d+)\s*)?', text.lower())
+
+    if match is None:
+        sys.exit(f'{Color.RED}# Unknown switching condition "{text}"; must be pc=N, count=N, ram[N] or ram[N]=V.{Color.END}')
+
+    if match.group(1):
+        return (match.group(1), int(match.group(2)), None)
+
+    addr = int(match.group(3))
+
+    if addr >= RAM.SIZE:
+        sys.exit(f'{Color.RED}# RAM address [{addr}] in "{text}" is out of bounds!{Color.END}')
+
+    return ("ram", addr, None if match.group(4) is None else int(match.group(4)) & 0xFFFF)
+
+
+class Switching:
+    """ HACK CPU that switches to the board-level machine on demand
+
+        fast is the Hack (or Jit) CPU, board the Board (built the first time it is needed).
+        conditions are the parsed conditions (see parse_condition()) that switch to the boards
+        when they become true; held is whether each one held at the last check, and baseline
+        the values of the RAM cells watched for a change. stay is the number of instructions
+        to run on the boards before switching back (0 to stay there), left the number still to
+        run, and control whether the boards take the control signals from the timeline.
+    """
+
+    RAM_SIZE = RAM.SIZE
+
+    def __init__(self, fast, conditions, stay=0, control=True):
+
+        self.fast = fast
+        self.board = None
+        self.conditions = conditions
+        self.stay = stay
+        self.left = 0
+        self.control = control
+        self.on_board = False
+
+        self.arm()
+
+    # The CPU running the program.
+
+    @property
+    def cpu(self):
+
+        return self.board if self.on_board else self.fast
+
+    @property
+    def instr_count(self):
+
+        return self.cpu.instr_count
+
+    @property
+    def ticks(self):
+
+        return self.board.ticks if self.board else None
+
+    @property
+    def written(self):
+
+        return self.cpu.written
+
+    @property
+    def pc(self):
+
+        return self.cpu.pc
+
+    @pc.setter
+    def pc(self, value):
+
+        self.cpu.pc = value
+
+    @property
+    def a(self):
+
+        return self.cpu.a
+
+    @property
+    def d(self):
+
+        return self.cpu.d
+
+    def peek(self, addr):
+
+        return self.cpu.peek(addr)
+
+    # The test script setting a watched cell is not a change made by the program, so it
+    # becomes the value watched for a change.
+
+    def poke(self, addr, value):
+
+        self.cpu.poke(addr, value)
+
+        if not self.on_board and addr in self.baseline:
+            self.baseline[addr] = self.fast.peek(addr)
+            self.held = [self.holds(condition) for condition in self.conditions]
+
+    def halted(self):
+
+        return self.cpu.halted()
+
+    # Conditions.
+
+    def holds(self, condition):
+
+        kind, number, value = condition
+
+        if kind == "pc":
+            return self.fast.pc == number
+        if kind == "count":
+            return self.fast.instr_count >= number
+        if value is None:
+            return self.fast.peek(number) != self.baseline[number]
+
+        return self.fast.peek(number) == value
+
+    # Start watching the conditions from the current state: they only switch to the boards
+    # when they become true, not if they already are.
+
+    def arm(self):
+
+        self.baseline = {number: self.fast.peek(number) for kind, number, _ in self.conditions if kind == "ram"}
+        self.held = [self.holds(condition) for condition in self.conditions]
+
+    # True if a condition just became true.
+
+    def triggered(self):
+
+        held = [self.holds(condition) for condition in self.conditions]
+        fired = any(now and not before for now, before in zip(held, self.held))
+        self.held = held
+
+        return fired
+
+    # Move the state to the boards, and the other way round.
+
+    def to_board(self):
+
+        if self.board is None:
+            self.board = build_cpu(asm=self.fast.asm, code=self.fast.rom, engine="board")
+
+        self.board.load(self.fast)
+
+        if self.control:
+            start_timeline(self.board)
+
+        self.on_board = True
+        self.left = self.stay
+
+        print(f'{Color.YELLOW}# Switching to the boards at instruction {self.board.instr_count + 1}, PC = {self.board.pc}.{Color.END}')
+
+    def to_fast(self):
+
+        board = self.board
+        fast = self.fast
+
+        fast.pc = board.pc
+        fast.a = board.a
+        fast.d = board.d
+        fast.prev_pc = board.prev_pc
+        fast.instr_count = board.instr_count
+        fast.ram[:] = array('H', board.machine["RAM"].state["DATA"])
+        fast.written.update(board.written)
+
+        self.on_board = False
+        self.arm()
+
+        print(f'{Color.YELLOW}# Switching to the HACK CPU at instruction {fast.instr_count + 1}, PC = {fast.pc}.{Color.END}')
+
+    # Execute one instruction: quietly on the HACK CPU, with tracing on the boards.
+
+    def step(self, trace=T_OFF):
+
+        if self.on_board:
+            self.board.step(trace)
+            self.left -= 1
+            if self.left == 0 and self.stay:
+                self.to_fast()
+        else:
+            self.fast.step()
+            if self.triggered():
+                self.to_board()
+
+    # Execute up to count instructions, stopping early if the program halts. The HACK CPU
+    # runs one instruction at a time while watching PC or RAM, and up to the next count
+    # otherwise.
+
+    def run(self, count):
+
+        executed = 0
+
+        while executed < count and not (executed and self.halted()):
+
+            if self.on_board:
+                chunk = count - executed
+                if self.stay:
+                    chunk = min(chunk, self.left)
+                done = self.board.run(chunk)
+                self.left -= done
+                if self.left == 0 and self.stay:
+                    self.to_fast()
+            else:
+                chunk = count - executed
+                for (kind, number, _), held in zip(self.conditions, self.held):
+                    if kind != "count":
+                        chunk = 1
+                    elif not held:
+                        chunk = min(chunk, number - self.fast.instr_count)
+                done = self.fast.run(max(chunk, 1))
+                if self.triggered():
+                    self.to_board()
+
+            executed += done
+
+        return executed
+
+
+# -----------------------------------------------------------------------------------
+# Checkpoints. A snapshot is the complete state of a CPU (Board, Hack, Jit or Lockstep),
+# including every component's inputs, outputs, power and state, the sequencer and clock,
+# and the written pages of RAM, as compressed binary data. Restoring a snapshot creates a
+# new CPU; forking copies one in-process, sharing RAM pages until they are written.
+# -----------------------------------------------------------------------------------
+
+def snapshot(cpu):
+
+    return zlib.compress(pickle.dumps(cpu, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def restore(data):
+
+    return pickle.loads(zlib.decompress(data))
+
+
+def fork(cpu):
+
+    return copy.deepcopy(cpu)
+
+
+# -----------------------------
+# Run the test.
+# -----------------------------
+
+def validate(cpu, test, results, trace):
+
+    try:
+        run_script(cpu=cpu, test=test, results=results, trace=trace)
+    except SystemExit:
+        dump_flight(cpu)
+        raise
+
+    print(f'{Color.GREEN}# SCRIPT VALIDATED CORRECTLY!{Color.END}')
+
+
+# Run a test script (compiled by compile_script()), checking the output against the results.
+# Exits on the first error.
+
+def run_script(cpu, test, results, trace):
+
+    # Get a variable's value.
+
+    def var_get(ref):
+
+        if ref == "pc":
+            return cpu.pc
+        else:
+            value = cpu.peek(ref[1])
+            return value - 65536 if value > 32757 else value    # 2's complement
+
+    # Set a variable's value.
+
+    def var_set(ref, value):
+
+        if ref == "pc":
+            cpu.pc = value
+            print(f'{Color.GREEN}Set: PC = {value}')
+        else:
+            cpu.poke(ref[1], value)
+            print(f'{Color.GREEN}Set: RAM[{ref[1]}] = {value}{Color.END}')
+
+    # The state of the machine, as far as the program can tell: registers, and the cells
+    # written since the start of the loop (the others haven't changed). None if too many
+    # cells were written to keep track of.
+
+    def machine_state():
+
+        if len(cpu.written) > MAX_LOOP_CELLS:
+            return None
+
+        return (cpu.pc, cpu.a, cpu.d, tuple(sorted((addr, cpu.peek(addr)) for addr in cpu.written)))
+
+    # Run a loop that just runs the machine for a number of passes of ticks instructions.
+    # Stops early if the machine halts (loops on the same instruction).
+
+    def run_loop(count, ticks):
+
+        # The ISA engines run the whole loop in one go (unless tracing every instruction),
+        # which is faster than checking it for cycles.
+
+        if trace == T_OFF and not isinstance(cpu, Board):
+            if cpu.run(count * ticks) < count * ticks:
+                print(f'{Color.YELLOW}Program Halt detected, exiting loop.{Color.END}')
+            return
+
+        # The board runs one instruction at a time anyway, so it checks the state at the end
+        # of each pass. If the machine is back in a state it was in at the end of an earlier
+        # pass, it is in a cycle, and all that is left to do is get to where it would be in
+        # the cycle when the loop ends. (Not when co-simulating: every instruction has to be
+        # checked.)
+
+        seen = {} if isinstance(cpu, Board) else None
+        if seen is not None:
+            cpu.written.clear()
+
+        passes = count
+
+        while passes > 0:
+
+            for _ in range(ticks):
+                cpu.step(trace)
+
+            if cpu.halted():
+                print(f'{Color.YELLOW}Program Halt detected, exiting loop.{Color.END}')
+                return
+
+            passes -= 1
+
+            if seen is not None and passes > 0:
+                state = machine_state()
+                if state is None:
+                    seen = None
+                elif state in seen and seen[state] - passes < passes:
+                    period = seen[state] - passes
+                    remaining = passes % period
+                    print(f'{Color.YELLOW}Program loop detected (every {period} passes), skipping {passes - remaining} passes.{Color.END}')
+                    for _ in range(remaining * ticks):
+                        cpu.step(trace)
+                    return
+                else:
+                    seen[state] = passes
+
+    # Run a list of steps.
+
+    def run_plan(plan):
+
+        nonlocal output_list, output
+
+        for step in plan:
+
+            cmd = step[0]
+
+            if cmd == "ignore":
+
+                print(f'{Color.YELLOW}Ignored: {step[1]}{Color.END}')
+
+            elif cmd == "output-list":
+
+                _, names, output_list = step
+                if names != results[0]:
+                    sys.exit(f'{Color.RED}Error: output-list {names} does not match results {results[0]}.{Color.END}')
+                output = [names]
+                print(f'{Color.GREEN}Output List: {output_list}{Color.END}')
+
+            elif cmd == "set":
+
+                var_set(step[1], step[2])
+
+            elif cmd == "repeat":
+
+                _, count, body, ticks = step
+                print(f'{Color.GREEN}Repeat {count} times:{Color.END}')
+
+                if ticks:
+                    run_loop(count, ticks)
+                else:
+                    for _ in range(count):
+                        run_plan(body)
+                        if cpu.halted():
+                            print(f'{Color.YELLOW}Program Halt detected, exiting loop.{Color.END}')
+                            break
+
+            elif cmd == "ticktock":
+
+                cpu.step(trace)
+
+            elif cmd == "output":
+
+                values = [str(signed(var_get(item))) for item in output_list]
+                output.append(values)
+                if len(output) <= len(results):
+                    expected = results[len(output)-1]
+                    if values != expected:
+                        print(f'{Color.RED}Output   : {values}{Color.END}')
+                        print(f'{Color.RED}Expected : {expected}{Color.END}')
+                        sys.exit(f'{Color.RED}Error: Output {values} does not match expected {expected}.{Color.END}')
+                    else:
+                        print(f'{Color.GREEN}Output correct: {values}{Color.END}')
+                else:
+                    print(f'{Color.RED}Output   : {values}{Color.END}')
+                    sys.exit(f'{Color.RED}More outputs than test results{Color.END}')
+
+    # Run through the test script.
+
+    output_list = []
+    output = []
+
+    run_plan(test)
 
 
 # -----------------------------------------------------------------------------------
@@ -752,7 +2017,8 @@ def setup_v1(asm, code, trace):
     machine = {board.name: board for board in machine}
 
     reset.set()
-    signals, ps_sources, ps_order = initial_state_of(machine)
+    signals = Netlist(machine)
+    ps_sources, ps_order = initial_state_of(signals)
     signals = settle(machine=machine, signals=signals, trace=T_OFF)
 
     if trace != T_OFF:
@@ -857,7 +2123,8 @@ def setup_v2(asm, code, trace):
     machine = {board.name: board for board in machine}
 
     reset.set()
-    signals, ps_sources, ps_order = initial_state_of(machine)
+    signals = Netlist(machine)
+    ps_sources, ps_order = initial_state_of(signals)
     signals = settle(machine=machine, signals=signals, trace=T_OFF)
 
     if USAGE:
@@ -884,57 +2151,718 @@ def setup_v2(asm, code, trace):
 
 
 # -----------------------------
-# Main program
+# Run the test, sharded. Test scripts like Mult.tst are a series of independent cases,
+# each of which restarts the program with a top-level "set pc" and then sets up its
+# arguments, runs and outputs. The script is split into segments at these restarts, and
+# each segment is run in its own process, from a copy of the freshly reset machine, and
+# checked against its own rows of the results. The outputs are merged in order.
+#
+# This only works if the cases really are independent: if the program doesn't depend on
+# anything in RAM or the registers left over from the previous case. Besides the checks on
+# the script (see shard_script()), each case is run on a HACK CPU both after the cases
+# before it and from a fresh machine (see independent_cases()), and the script is run
+# sequentially if they don't agree.
+# -----------------------------
+
+# Split a compiled test script into segments: the first runs up to the first top-level
+# "set pc", and each of the others starts at one. The others are prefixed with the steps in
+# the first that don't change the machine (output-list...), and each segment comes with the
+# number of the first results row it outputs. Returns None if the script can't be split
+# (fewer than two segments, outputs inside repeat loops, or a segment that doesn't set up
+# the machine again: before running it, each segment must set every RAM cell that the
+# segments before it set, and every RAM cell in the output-list).
+
+def shard_script(test):
+
+    segments = [[]]
+    header = []
+
+    for step in test:
+
+        if step[0] == "set" and step[1] == "pc" and segments[-1]:
+            segments.append([])
+        elif step[0] == "repeat" and has_output(step[2]):
+            return None
+        elif step[0] in ("ignore", "output-list") and len(segments) == 1:
+            header.append(step)
+
+        segments[-1].append(step)
+
+    if len(segments) < 2:
+        return None
+
+    outputs = {ref[1] for step in header if step[0] == "output-list" for ref in step[2] if ref != "pc"}
+    cells = set()
+
+    for index, segment in enumerate(segments):
+        if index > 0 and not (cells | outputs) <= initialized_cells(segment):
+            return None
+        cells |= {step[1][1] for step in segment if step[0] == "set" and step[1] != "pc"}
+
+    shards = []
+    row = 1
+
+    for index, segment in enumerate(segments):
+        shards.append((segment if index == 0 else header + segment, row))
+        row += len([step for step in segment if step[0] == "output"])
+
+    return shards
+
+
+# The RAM cells a segment sets before it first runs the machine.
+
+def initialized_cells(segment):
+
+    cells = set()
+
+    for step in segment:
+        if step[0] in ("repeat", "ticktock"):
+            break
+        if step[0] == "set" and step[1] != "pc":
+            cells.add(step[1][1])
+
+    return cells
+
+
+# The rows of the results each shard checks: the header row and the shard's own rows.
+
+def shard_results(shards, results):
+
+    bounds = [row for _, row in shards] + [len(results)]
+
+    return [[results[0]] + results[bounds[index]:bounds[index + 1]] for index in range(len(shards))]
+
+
+# Run each case of a sharded test script on a HACK CPU twice: after the cases before it (as
+# the script runs sequentially), and from a fresh machine (as its shard does). Returns True if
+# every case gets its results both ways, in the same number of instructions, which it
+# wouldn't if it depended on a cell the program wrote in an earlier case and the script
+# doesn't set up again (or if the test fails, which is then reported by a sequential run).
+
+def independent_cases(shards, rows, code):
+
+    sequential = Hack(code)
+
+    for index, (script, _) in enumerate(shards):
+
+        executed = set()
+
+        for cpu in [sequential] + ([Hack(code)] if index > 0 else []):
+            start = cpu.instr_count
+            try:
+                with redirect_stdout(io.StringIO()):
+                    run_script(cpu=cpu, test=script, results=rows[index], trace=T_OFF)
+            except SystemExit:
+                return False
+            executed.add(cpu.instr_count - start)
+
+        if len(executed) > 1:
+            return False
+
+    return True
+
+
+# True if a plan outputs anything.
+
+def has_output(plan):
+
+    return any(step[0] == "output" or (step[0] == "repeat" and has_output(step[2])) for step in plan)
+
+
+# Run one segment of a test script on a machine restored from a snapshot, in a worker
+# process. Returns (exit message or None, printed output, instructions executed).
+
+def run_shard(data, mode, display, control, test, results, trace):
+
+    global settle_mode, ps_sources, ps_order, timeline
+
+    settle_mode = mode
+    ps_sources, ps_order = display
+    cpu = restore(data)
+    timeline = None
+
+    if control:
+        start_timeline(cpu)
+    output = io.StringIO()
+
+    try:
+        with redirect_stdout(output):
+            try:
+                run_script(cpu=cpu, test=test, results=results, trace=trace)
+            except SystemExit:
+                dump_flight(cpu)
+                raise
+    except SystemExit as exit:
+        return (str(exit.code) if exit.code else "Error: Test script failed.", output.getvalue(), cpu.instr_count)
+
+    return (None, output.getvalue(), cpu.instr_count)
+
+
+def validate_sharded(cpu, test, results, code, trace, jobs):
+
+    shards = shard_script(test)
+    rows = shard_results(shards, results) if shards else None
+
+    if shards is None or not independent_cases(shards, rows, code):
+        print(f'{Color.YELLOW}Test script has no independent cases, not sharding.{Color.END}')
+        validate(cpu=cpu, test=test, results=results, trace=trace)
+        return
+
+    print(f'{Color.GREEN}Running {len(shards)} test cases, {min(jobs, len(shards))} at a time.{Color.END}')
+
+    data = snapshot(cpu)
+    scripts = [script for script, _ in shards]
+
+    with ProcessPoolExecutor(max_workers=max(1, min(jobs, len(shards)))) as pool:
+        outcomes = list(pool.map(run_shard, [data] * len(shards), [settle_mode] * len(shards), [(ps_sources, ps_order)] * len(shards),
+                                 [timeline is not None] * len(shards), scripts, rows, [trace] * len(shards)))
+
+    for index, (error, output, instructions) in enumerate(outcomes):
+        print(f'{Color.BOLD}# Test case {index + 1} ({instructions} instructions):{Color.END}')
+        print(output, end="")
+        if error:
+            sys.exit(error)
+
+    print(f'{Color.GREEN}# SCRIPT VALIDATED CORRECTLY!{Color.END}')
+
+
+# -----------------------------
+# Batching the independent cases of a test script: each case runs on a lane of a Batch of
+# HACK CPUs (see Modules/Batch.py), and they all run together. This needs every case to have
+# the same steps (setting different values, and checking different rows of results), which
+# is the case for scripts like Mult.tst.
 # -----------------------------
 
-if sys.version_info < (3, 7):
-    sys.exit(f'{Color.RED}# Error: This program requires Python 3.7.0 or later.{Color.END}')
+# The steps of a plan, without the values set or the number of instructions run by the
+# loops that only run the machine.
+
+def plan_shape(plan):
+
+    return tuple(("run",) if step[0] == "repeat" and step[3] else
+                 ("repeat", step[1], plan_shape(step[2])) if step[0] == "repeat" else step[0] for step in plan)
+
+
+# Run the plans of the cases in lockstep, one lane each, adding the outputs of each lane to
+# outputs[lane] as (values, expected) pairs. The plans have the same shape.
+
+def run_batch(batch, plans, output_list, outputs):
+
+    for steps in zip(*plans):
+
+        cmd = steps[0][0]
 
-print(sys.argv)
+        if cmd == "set":
+            for lane, (_, ref, value) in enumerate(steps):
+                if ref == "pc":
+                    batch.pc[lane] = value
+                else:
+                    batch.poke(lane, ref[1], value)
+
+        elif cmd == "repeat":
+            _, count, body, ticks = steps[0]
+            if ticks:
+                batch.run([step[1] * step[3] for step in steps])
+            else:
+                for _ in range(count):
+                    run_batch(batch, [step[2] for step in steps], output_list, outputs)
+
+        elif cmd == "ticktock":
+            batch.run(1)
+
+        elif cmd == "output":
+            for lane in range(batch.lanes):
+                values = []
+                for ref in output_list:
+                    value = int(batch.pc[lane]) if ref == "pc" else batch.peek(lane, ref[1])
+                    value = value - 65536 if ref != "pc" and value > 32757 else value      # 2's complement (as in run_script())
+                    values.append(str(signed(value)))
+                outputs[lane].append(values)
+
+
+# Returns False (without running anything) if the test script can't be batched.
+
+def validate_batch(test, results, code, asm):
+
+    shards = shard_script(test)
+
+    # The first case starts without a "set PC" (the machine is fresh), and the steps that
+    # don't change the machine are left out.
+
+    plans = [[step for step in script if step[0] not in ("ignore", "output-list")] for script, _ in shards or []]
 
-if len(sys.argv) not in [2, 3]:
-    sys.exit(f'{Color.RED}# Usage: python3 validate.py [Test name (subfolder of Tests folder)] {{Trace Level: [N]one|[I]nstruction|[C]lock|[S]ettle}}{Color.END}')
+    if plans:
+        plans[0].insert(0, ("set", "pc", 0))
 
-test_path = 'Tests/' + sys.argv[1]
+    if len(plans) < 2 or len({plan_shape(plan) for plan in plans}) > 1 or not independent_cases(shards, shard_results(shards, results), code):
+        print(f'{Color.YELLOW}Test script has no independent cases with the same steps, not batching.{Color.END}')
+        return False
 
-if not os.path.exists(test_path):
-    sys.exit(f'{Color.RED}# {test_path} : does not exist.{Color.END}')
+    output_list = next((step for step in test if step[0] == "output-list"), None)
+
+    if output_list is None:
+        sys.exit(f'{Color.RED}Error: Test script has no output-list.{Color.END}')
+
+    _, names, output_list = output_list
+
+    if names != results[0]:
+        sys.exit(f'{Color.RED}Error: output-list {names} does not match results {results[0]}.{Color.END}')
+
+    print(f'{Color.GREEN}Running {len(plans)} test cases in one batch.{Color.END}')
+
+    batch = Batch(code=code, lanes=len(plans), asm=asm)
+    outputs = [[] for _ in plans]
+    start = time.perf_counter()
+
+    run_batch(batch, plans, output_list, outputs)
+
+    seconds = time.perf_counter() - start
+    bounds = [row for _, row in shards] + [len(results)]
+
+    for lane, values_list in enumerate(outputs):
+        print(f'{Color.BOLD}# Test case {lane + 1} ({batch.instr_count[lane]} instructions):{Color.END}')
+        expected_rows = results[bounds[lane]:bounds[lane + 1]]
+        for row, values in enumerate(values_list):
+            if row >= len(expected_rows):
+                print(f'{Color.RED}Output   : {values}{Color.END}')
+                sys.exit(f'{Color.RED}More outputs than test results{Color.END}')
+            if values != expected_rows[row]:
+                print(f'{Color.RED}Output   : {values}{Color.END}')
+                print(f'{Color.RED}Expected : {expected_rows[row]}{Color.END}')
+                sys.exit(f'{Color.RED}Error: Output {values} does not match expected {expected_rows[row]}.{Color.END}')
+            print(f'{Color.GREEN}Output correct: {values}{Color.END}')
+
+    instructions = int(batch.instr_count.sum())
+
+    print(f'{Color.GREEN}# {instructions} instructions in {seconds:.2f}s ({instructions / seconds if seconds else 0:.0f} per second).{Color.END}')
+    print(f'{Color.GREEN}# SCRIPT VALIDATED CORRECTLY!{Color.END}')
 
-if not os.path.isdir(test_path):
-    sys.exit(f'{Color.RED}# {test_path} : not a folder.{Color.END}')
+    return True
 
-trace_level = T_ON
 
-if len(sys.argv) == 3:
-    if sys.argv[2].lower() == 'n':
+# -----------------------------
+# Profiling: counts the updates of each board and the time they take, and the number of
+# iterations it takes to settle the hardware, for tuning the board models and the settling
+# algorithms.
+# -----------------------------
+
+class Profiler:
+    """ Board and settling profiler
+
+        boards[name] is [class name, updates, seconds] for each board that is being timed.
+        settles[n] is the number of times the hardware took n iterations to settle.
+    """
+
+    def __init__(self):
+
+        self.boards = {}
+        self.settles = Counter()
+        self.timed = []
+
+    # Time the updates of every board of the machine, by wrapping their evaluate().
+
+    def attach(self, machine):
+
+        for board in machine.values():
+
+            stats = self.boards.setdefault(board.name, [type(board).__name__, 0, 0.0])
+
+            def timed(evaluate=board.evaluate, stats=stats):
+                start = time.perf_counter()
+                evaluate()
+                stats[2] += time.perf_counter() - start
+                stats[1] += 1
+
+            board.evaluate = timed
+            self.timed.append(board)
+
+    # Take the wrappers off again (they can't be pickled).
+
+    def detach(self):
+
+        for board in self.timed:
+            del board.evaluate
+
+        self.timed = []
+
+    # The report, as a dictionary ready for JSON.
+
+    def report(self, cpu, instructions, ticks, seconds):
+
+        classes = {}
+
+        for name, (kind, updates, board_time) in self.boards.items():
+            stats = classes.setdefault(kind, {"boards": 0, "updates": 0, "seconds": 0.0})
+            stats["boards"] += 1
+            stats["updates"] += updates
+            stats["seconds"] += board_time
+
+        settles = sum(self.settles.values())
+
+        return {"engine": type(cpu).__name__,
+                "settle": SETTLE_MODES[settle_mode],
+                "seconds": seconds,
+                "instructions": instructions,
+                "ticks": ticks,
+                "instructions_per_second": instructions / seconds if seconds else None,
+                "ticks_per_second": ticks / seconds if seconds and ticks is not None else None,
+                "settles": settles,
+                "memo": None if memo is None else {"hits": memo.hits, "misses": memo.misses, "entries": len(memo.entries), "ticks": memo.count},
+                "pure": pure_stats() if pure_caching else None,
+                "timeline": None if timeline is None else {"hits": timeline.hits, "misses": timeline.misses, "entries": len(timeline.entries)},
+                "settle_iterations": {str(n): count for n, count in sorted(self.settles.items())},
+                "mean_settle_iterations": sum(n * count for n, count in self.settles.items()) / settles if settles else None,
+                "classes": dict(sorted(classes.items(), key=lambda item: -item[1]["seconds"])),
+                "boards": [{"name": name, "class": kind, "updates": updates, "seconds": board_time}
+                           for name, (kind, updates, board_time) in sorted(self.boards.items(), key=lambda item: -item[1][2])]}
+
+
+def start_profile(cpu):
+
+    global profile
+
+    profile = Profiler()
+    board = cpu.board if isinstance(cpu, Lockstep) else cpu
+
+    if isinstance(board, Board):
+        profile.attach(board.machine)
+
+    return (time.perf_counter(), cpu.instr_count, getattr(cpu, "ticks", None))
+
+
+def stop_profile(cpu, start, path):
+
+    global profile
+
+    start_time, start_instructions, start_ticks = start
+    seconds = time.perf_counter() - start_time
+    ticks = None if start_ticks is None else cpu.ticks - start_ticks
+
+    profile.detach()
+    report = profile.report(cpu, cpu.instr_count - start_instructions, ticks, seconds)
+    profile = None
+
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(f'{Color.GREEN}# Wrote profile to {path}: {report["instructions"]} instructions in {seconds:.2f}s.{Color.END}')
+
+
+# -----------------------------
+# The control timeline. When timeline is set, clock_edge() takes the control signals from
+# it instead of simulating the control boards (see Modules/Timeline.py).
+# -----------------------------
+
+def start_timeline(cpu):
+
+    global timeline
+
+    board = cpu.board if isinstance(cpu, Lockstep) else cpu
+    timeline = Timeline(board.signals, board.clock) if isinstance(board, Board) else None
+
+
+# -----------------------------
+# Caching the clock ticks. When memo is set, tick() looks every tick up in it before
+# settling the hardware (see Modules/Memo.py).
+# -----------------------------
+
+def start_memo(cpu, size):
+
+    global memo
+
+    board = cpu.board if isinstance(cpu, Lockstep) else cpu
+
+    if not isinstance(board, Board):
+        sys.exit(f'{Color.RED}# The tick cache requires the board engine.{Color.END}')
+
+    memo = TickCache(board.signals, board.clock, size=size)
+
+
+def stop_memo():
+
+    global memo
+
+    lookups = memo.hits + memo.misses
+    rate = 100 * memo.hits / lookups if lookups else 0
+
+    print(f'{Color.GREEN}# Tick cache: {memo.hits} hits, {memo.misses} misses ({rate:.1f}%), {memo.count} ticks kept for {len(memo.entries)} states.{Color.END}')
+    memo = None
+
+
+# Print the statistics of the pure component caches (see set_pure_caching() in Modules/Comp.py).
+
+def print_pure_stats():
+
+    for name, stats in pure_stats().items():
+        lookups = stats["skips"] + stats["hits"] + stats["misses"]
+        saved = 100 * (stats["skips"] + stats["hits"]) / lookups if lookups else 0
+        print(f'{Color.GREEN}# {name:12s} {stats["skips"]:8d} unchanged, {stats["hits"]:8d} hits, {stats["misses"]:8d} misses '
+              f'({saved:.1f}% not computed), {stats["entries"]} patterns kept.{Color.END}')
+
+
+# -----------------------------
+# Recording the signals. Recordings are made by tick() when recorder is set, and can be
+# replayed on the terminal (like the [C]lock trace level) or exported to VCD.
+# -----------------------------
+
+def start_recording(cpu, path):
+
+    global recorder
+
+    board = cpu.board if isinstance(cpu, Lockstep) else cpu
+
+    if not isinstance(board, Board):
+        sys.exit(f'{Color.RED}# Recording requires the board engine.{Color.END}')
+
+    recorder = Recorder(path, board.signals.names, board.signals.values, time=board.ticks, sources=ps_sources, order=ps_order)
+
+
+def stop_recording(path, vcd_path=None):
+
+    global recorder
+
+    recorder.close()
+    print(f'{Color.GREEN}# Recorded {recorder.count} clock ticks to {path}.{Color.END}')
+    recorder = None
+
+    if vcd_path:
+        write_vcd(path, vcd_path)
+        print(f'{Color.GREEN}# Exported the recording to {vcd_path}.{Color.END}')
+
+
+def replay(path):
+
+    header = read_header(path)
+    previous = dict(zip(header["names"], header["values"]))
+
+    for time, values in frames(path):
+        signals = dict(zip(header["names"], values))
+        print(f'{Color.GREEN}Clock tick {time}:{Color.END}')
+        print_state(signals, previous, header["sources"], header["order"])
+        previous = signals
+
+
+# -----------------------------
+# Build the CPU for a program: either the simulated hardware, or the
+# instruction-level HACK CPU.
+# -----------------------------
+
+def build_cpu(asm, code, engine="board", cosim=0, trace=T_OFF):
+
+    if engine == "isa":
+        return Hack(code=code, asm=asm)
+
+    if engine == "jit":
+        return Jit(code=code, asm=asm)
+
+    # Wire up the hardware, and run an instruction with RESET set (by setup).
+
+    machine, signals, clock = setup_v2(asm=asm, code=code, trace=trace)
+    cpu = Board(machine=machine, signals=signals, clock=clock)
+    cpu.step(T_OFF)
+
+    # Clear RESET, and start the flight recorder afresh (without the RESET cycle).
+
+    cpu.release()
+
+    if flight is not None:
+        flight.clear()
+
+    if cosim > 0:
+        cpu = Lockstep(board=cpu, isa=Hack(code=code, asm=asm), every=cosim)
+
+    return cpu
+
+
+# -----------------------------
+# Main program
+# -----------------------------
+
+def main():
+
+    global settle_mode, flight, ps_sources, ps_order, pure_caching
+
+    if sys.version_info < (3, 7):
+        sys.exit(f'{Color.RED}# Error: This program requires Python 3.7.0 or later.{Color.END}')
+
+    print(sys.argv)
+
+    parser = argparse.ArgumentParser(description="Validate Relay2Tetris hardware by simulating it in software.")
+    parser.add_argument("test", nargs="?", help="Test name (subfolder of Tests folder)")
+    parser.add_argument("trace", nargs="?", default="i", help="Trace Level: [N]one|[I]nstruction|[C]lock|[S]ettle")
+    parser.add_argument("--engine", choices=["board", "isa", "jit"], default="board",
+                        help="Simulate the boards, or just execute the instructions one at a time or as compiled blocks (fast, but does not validate the hardware)")
+    parser.add_argument("--cosim", type=int, default=0, metavar="N",
+                        help="Run the HACK CPU alongside the boards, and check they agree every N instructions")
+    parser.add_argument("--save", metavar="FILE", help="Save a checkpoint of the machine to FILE when the run ends")
+    parser.add_argument("--restore", metavar="FILE", help="Start from the machine saved in FILE instead of a new one")
+    parser.add_argument("--shard", type=int, default=0, metavar="N",
+                        help="Run the independent cases of the test script in N processes (the cases must not depend on each other: "
+                             "each one restarts the program with set PC, sets all the RAM cells the others set, and doesn't read cells "
+                             "the program wrote in the others)")
+    parser.add_argument("--settle", choices=SETTLE_MODES, default="random",
+                        help="Settling algorithm: update all boards in random order, only those whose inputs changed, those in levelized order, or all boards in random order seeing each other's updates (races)")
+    parser.add_argument("--record", metavar="FILE", help="Record the signals after every clock tick to FILE")
+    parser.add_argument("--vcd", metavar="FILE", help="Export the recording to FILE as a VCD waveform when the run ends")
+    parser.add_argument("--replay", metavar="FILE", help="Print the signals recorded in FILE tick by tick, instead of running a test")
+    parser.add_argument("--profile", metavar="FILE", help="Write a JSON profile of the run (board updates, settling, speed) to FILE")
+    parser.add_argument("--flight", type=int, default=FLIGHT_INSTRUCTIONS, metavar="N",
+                        help="Keep the last N instructions (0 for none) in the flight recorder, printed if the run fails")
+    parser.add_argument("--memo", type=int, default=0, metavar="N",
+                        help="Cache up to N clock ticks (0 for none), keyed by the machine state before them, instead of settling the hardware again")
+    parser.add_argument("--no-timeline", action="store_true",
+                        help="Simulate the clock, sequencer and control matrix on every tick, instead of taking the control signals from the timeline")
+    parser.add_argument("--pure", type=int, default=0, metavar="N",
+                        help="Cache the outputs of the pure components (ALU, multiplexers, decoder...) for up to N input patterns per class (0 for none)")
+    parser.add_argument("--switch", action="append", default=[], metavar="COND",
+                        help="Run on the isa or jit engine until COND (pc=N, count=N, ram[N] or ram[N]=V) becomes true, then on the boards")
+    parser.add_argument("--board", type=int, default=0, metavar="N",
+                        help="With --switch, go back to the isa or jit engine after N instructions on the boards (0 to stay on them)")
+    parser.add_argument("--batch", action="store_true",
+                        help="Run the independent cases of the test script together, on a batch of HACK CPUs (needs NumPy)")
+    args = parser.parse_args()
+
+    if args.replay:
+        replay(args.replay)
+        return
+
+    if args.test is None:
+        parser.error("the following arguments are required: test")
+
+    if args.vcd and not args.record:
+        sys.exit(f'{Color.RED}# --vcd exports the recording made with --record.{Color.END}')
+
+    if args.record and args.shard > 0:
+        sys.exit(f'{Color.RED}# Recording requires a single process (no --shard).{Color.END}')
+
+    if args.profile and args.shard > 0:
+        sys.exit(f'{Color.RED}# Profiling requires a single process (no --shard).{Color.END}')
+
+    if args.batch and args.shard > 0:
+        sys.exit(f'{Color.RED}# --batch and --shard are two ways of running the cases of a test script; choose one.{Color.END}')
+
+    if args.batch and (args.restore or args.save or args.record or args.profile or args.memo > 0 or args.cosim > 0 or args.switch):
+        sys.exit(f'{Color.RED}# --batch runs the cases on a batch of HACK CPUs of its own, so it can\'t restore, save, record, profile, cache ticks, co-simulate or switch.{Color.END}')
+
+    if args.memo > 0 and args.shard > 0:
+        sys.exit(f'{Color.RED}# The tick cache requires a single process (no --shard).{Color.END}')
+
+    test_path = 'Tests/' + args.test
+
+    if not os.path.exists(test_path):
+        sys.exit(f'{Color.RED}# {test_path} : does not exist.{Color.END}')
+
+    if not os.path.isdir(test_path):
+        sys.exit(f'{Color.RED}# {test_path} : not a folder.{Color.END}')
+
+    trace_level = T_ON
+
+    if args.trace.lower() == 'n':
         trace_level = T_OFF
-    elif sys.argv[2].lower() == 'c':
+    elif args.trace.lower() == 'c':
         trace_level = T_FULL
-    elif sys.argv[2].lower() == 's':
+    elif args.trace.lower() == 's':
         trace_level = T_SETTLE
-    elif sys.argv[2].lower() != 'i':
+    elif args.trace.lower() != 'i':
         sys.exit(f'{Color.RED}# Unknown trace level; must be [N]one|[I]nstruction|[C]lock|[S]ettle.{Color.END}')
 
-# Load testing environment.
+    if args.cosim > 0 and args.engine != "board":
+        sys.exit(f'{Color.RED}# Co-simulation requires the board engine.{Color.END}')
 
-asm, code, test, results = load_test(test_path, sys.argv[1])
+    if args.switch and args.engine == "board" and not args.restore:
+        sys.exit(f'{Color.RED}# Switching to the boards requires the isa or jit engine to start on.{Color.END}')
 
-# Wire up the hardware.
+    if args.board and not args.switch:
+        sys.exit(f'{Color.RED}# --board is the number of instructions to run on the boards after --switch.{Color.END}')
 
-machine, signals, clock = setup_v2(asm=asm, code=code, trace=trace_level)
+    conditions = [parse_condition(text) for text in args.switch]
 
-# Run an instruction with RESET st (by setup).
+    settle_mode = SETTLE_MODES.index(args.settle)
+    flight = FlightRecorder(instructions=args.flight) if args.flight > 0 else None
+    pure_caching = args.pure > 0
 
-signals, _ = cycle(machine=machine, signals=signals, clock=clock, instr_count=0, trace=T_OFF)
+    if pure_caching:
+        set_pure_caching(True, size=args.pure)
 
-# Clear RESET and run the test.
+    # Load testing environment.
 
-machine["RESET"].clr()
+    asm, code, test, results = load_test(test_path, args.test)
+    error = load_error(test_path, args.test)
 
-if test:
-    validate(machine=machine, signals=signals, test=test, results=results, trace=trace_level)
-else:
-    instr_count = 1
-    machine["PREV"].state["_PC"] = -1
-    while machine["PC"].state["DATA"] != machine["PREV"].state["_PC"]:
-        signals, instr_count = cycle(machine=machine, signals=signals, clock=clock, instr_count=instr_count, trace=trace_level)
+    # Run the cases of the test script on a batch of HACK CPUs, if they can be (otherwise the
+    # test is run on the engine as usual).
+
+    if args.batch:
+        if not test:
+            sys.exit(f'{Color.RED}# --batch runs the cases of a test script, and there is none.{Color.END}')
+        if validate_batch(test=test, results=results, code=code, asm=asm):
+            return
+
+    # Build the CPU, or restore it from a checkpoint.
+
+    if args.restore:
+        with open(args.restore, 'rb') as f:
+            cpu = restore(f.read())
+        print(f'{Color.GREEN}# Restored {type(cpu).__name__} from {args.restore}, at instruction {cpu.instr_count}.{Color.END}')
+        board = cpu.board if isinstance(cpu, (Lockstep, Switching)) else cpu
+        if isinstance(board, Board):
+            ps_sources, ps_order = initial_state_of(board.signals)     # For traces and the flight recorder
+    else:
+        cpu = build_cpu(asm=asm, code=code, engine=args.engine, cosim=args.cosim, trace=trace_level)
+
+    if conditions:
+        if not isinstance(cpu, Hack):
+            sys.exit(f'{Color.RED}# Switching to the boards requires the isa or jit engine to start on.{Color.END}')
+        cpu = Switching(fast=cpu, conditions=conditions, stay=args.board, control=not args.no_timeline)
+
+    if args.record:
+        start_recording(cpu, args.record)
+
+    if not args.no_timeline:
+        start_timeline(cpu)
+
+    if args.memo > 0:
+        start_memo(cpu, args.memo)
+
+    if args.profile:
+        profile_start = start_profile(cpu)
+
+    # Run the test (saving the final state of the machine and the recording, even if the
+    # test fails).
+
+    try:
+        if test and args.shard > 0:
+            validate_sharded(cpu=cpu, test=test, results=results, code=code, trace=trace_level, jobs=args.shard)
+        elif test:
+            validate(cpu=cpu, test=test, results=results, trace=trace_level)
+        elif trace_level == T_OFF:
+            cpu.run(sys.maxsize)
+        else:
+            while not cpu.halted():
+                cpu.step(trace_level)
+    except SystemExit as exit:
+        if error is not None and uncolor(str(exit.code)) == error:
+            print(f'{Color.GREEN}# STOPPED WITH THE EXPECTED ERROR!{Color.END}')
+            return
+        if not test:
+            dump_flight(cpu)    # (validate() does it for test scripts)
+        raise
+    else:
+        if error is not None:
+            sys.exit(f'{Color.RED}# Error: The run should have stopped with "{error}".{Color.END}')
+    finally:
+        if args.profile:
+            stop_profile(cpu, profile_start, args.profile)
+        if args.memo > 0:
+            stop_memo()
+        if pure_caching:
+            print_pure_stats()
+        if args.save:
+            with open(args.save, 'wb') as f:
+                f.write(snapshot(cpu))
+            print(f'{Color.GREEN}# Saved checkpoint to {args.save}, at instruction {cpu.instr_count}.{Color.END}')
+        if args.record:
+            stop_recording(args.record, args.vcd)
+
+
+if __name__ == "__main__":
+    main()